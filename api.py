@@ -1,73 +1,400 @@
 # api.py
+import asyncio
+import json
 import os
-from fastapi import FastAPI, Query
+import sqlite3
+import time
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-from db import get_connection, extract_schema
+from db import ConnectionPool, SchemaCatalog, ChangeTracker
 from retriever import SchemaRetriever
-from query_engine import configure_gemini, nl_to_sql, run_sql
-from validator import repair_sql
-from explainer import explain_result
+from llm_client import get_client
+from query_engine import (configure_gemini, nl_to_sql_async, run_sql_page, format_result,
+                          make_page_token, parse_page_token, ExecutionBudget, SQL_MAX_ROWS)
+from validator import prepare_sql, repair_sql_async
+from explainer import explain_result_async
 from logger import log_query
-from context_manager import ContextManager
-from cache_manager import QueryCache
+from context_manager import SessionStore
+from cache_manager import QueryCache, ResultCache
+from profiler import StatsCatalog
+import metrics
+from metrics import span
 
 load_dotenv()
 api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
+if not api_key and get_client().backend.online:   # stub/replay backends run offline
     raise ValueError("❌ GOOGLE_API_KEY not found. Please set it in .env")
 
 configure_gemini(api_key)
 
 # --- Setup ---
-DB_NAME = "demo1.db"
-conn = get_connection(DB_NAME)
-cursor = conn.cursor()
-schema_info = extract_schema(DB_NAME)
-retriever = SchemaRetriever(schema_info)
+DB_NAME = os.getenv("DB_PATH", "demo1.db")
+STREAM_CHUNK_ROWS = 500
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "").lower() in ("1", "true", "yes")   # Server-Timing on responses
+pool = ConnectionPool(DB_NAME)   # read-only connections, one per in-flight query
+budget = ExecutionBudget()       # per-query time / VM-step / row limits
+schema = SchemaCatalog(DB_NAME)  # persisted; re-read only when PRAGMA schema_version moves
+schema_info = schema.schema_info
+retriever = SchemaRetriever(schema_info, tables=schema.tables)
+stats = StatsCatalog(DB_NAME)    # column profiles written by `python profiler.py`
 
-context = ContextManager()
-cache = QueryCache()
+sessions = SessionStore.from_env()   # conversation history per session_id
+tracker = ChangeTracker(DB_NAME)
+cache = QueryCache.from_env(tracker=tracker)
+results = ResultCache.from_env(tracker)   # executed pages by canonical SQL, until their tables change
 
 # --- FastAPI App ---
 app = FastAPI(title="NL2SQL API", version="1.0")
 
+@app.exception_handler(TimeoutError)
+async def pool_timeout(request: Request, exc: TimeoutError):
+    """Every pooled connection is busy (e.g. held by slow stream readers): tell the client to retry."""
+    return JSONResponse(status_code=503, content={"detail": f"Database busy: {exc}"})
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """Request counts + end-to-end time; per-stage Server-Timing header when TIMING_HEADERS is set."""
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    timings = metrics.start_request()
+    with span("total"):
+        response = await call_next(request)
+    # Label by route template (/explain/{result_id}), never the raw path, to keep label values bounded
+    route = request.scope.get("route")
+    metrics.inc("nl2sql_requests_total", endpoint=getattr(route, "path", "unmatched"))
+    if TIMING_HEADERS:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
 class QueryRequest(BaseModel):
     question: str
+    session_id: Optional[str] = None   # omit to start a new session; the id is returned
+    explain: bool = True   # False: skip the explanation; fetch it later via /explain/{result_id}
+    page_size: int = SQL_MAX_ROWS   # rows per page (capped at SQL_MAX_ROWS); see /page
+
+def page_limit(page_size):
+    return max(1, min(page_size, SQL_MAX_ROWS))
+
+def retrieve_schema(question):
+    """Relevant schema for a question, picking up schema changes first (one PRAGMA when none)."""
+    global schema_info
+    with span("retrieve"):
+        changes = schema.refresh()
+        if changes:
+            retriever.update(schema.tables, *changes)
+            schema_info = schema.schema_info
+            tracker.reload()
+        return retriever.retrieve(question)
+
+def search_exact(enriched_question):
+    """Exact-repeat cache tier: a hash lookup, no model call (checked before anything else starts)."""
+    with span("cache_search"):
+        return cache.search_exact(enriched_question)
+
+def search_similar(enriched_question, follow_up=False):
+    """Semantic cache tier; follow-ups only match exact repeats of the same context, so it is skipped."""
+    if follow_up:
+        return None
+    with span("cache_search"):
+        return cache.search_semantic(enriched_question)
+
+def execute(sql, limit=SQL_MAX_ROWS, offset=0):
+    """
+    Run SQL on a pooled connection (called from a worker thread).
+    Returns (json_result, ascii_result, next_token) for one page.
+    """
+    with span("execute"), pool.connection() as conn:
+        return run_sql_page(conn.cursor(), sql, limit, offset, budget, results)
+
+async def explanation_for(question, sql, ascii_result, want=True):
+    """(result_id, explanation) — memoised; None when not wanted and not cached."""
+    result_id, explanation = cache.explanations.lookup(question, sql, ascii_result)
+    if explanation is None and want:
+        with span("explain"):
+            explanation = await explain_result_async(question, sql, ascii_result)
+        cache.explanations.put(result_id, explanation)
+    return result_id, explanation
+
+def prepare(sql, conn=None):
+    """
+    Local validation + deterministic fixes: (sql, error or None). Pass `conn`
+    when the caller already holds a pooled connection, so it does not wait
+    on the pool for a second one.
+    """
+    with span("validate"):
+        if conn is not None:
+            return prepare_sql(conn.cursor(), sql, schema_info)
+        with pool.connection() as conn:
+            return prepare_sql(conn.cursor(), sql, schema_info)
+
+def cached_page(sql, json_result, ascii_result, limit, more=False):
+    """
+    First page of a cached result. A token is issued only when rows remain:
+    beyond `limit` in the cached rows, or beyond them in the table (`more`).
+    """
+    next_token = make_page_token(sql, limit) if len(json_result) > limit or more else None
+    if len(json_result) > limit:
+        columns = list(json_result[0])
+        json_result, ascii_result = format_result(columns, [tuple(r.values()) for r in json_result[:limit]])
+    return json_result, ascii_result, next_token
+
+def cacheable_page(next_token, limit):
+    """
+    Whether a first page may go into the query cache: only a complete result
+    or a full SQL_MAX_ROWS page. A page cut short by a small page_size would
+    otherwise be served later as the whole answer (see cached_page).
+    """
+    return next_token is None or limit == SQL_MAX_ROWS
+
+def remember(session_id, question, enriched_question, sql, result, next_token, limit):
+    """
+    Cache + Context (blocking; run off the event loop). The cache is keyed
+    on the enriched question, so a follow-up is only reused with the same
+    history; see cacheable_page for which pages are cached.
+    """
+    with span("cache_add"):
+        if cacheable_page(next_token, limit):
+            cache.add(enriched_question, sql, result + (next_token is not None,))
+        sessions.add_entry(session_id, question, sql, result)
 
 @app.post("/ask")
-def ask(request: QueryRequest):
+async def ask(request: QueryRequest):
     question = request.question
+    limit = page_limit(request.page_size)
 
-    # Step 0: Check cache
-    cached = cache.search(question)
+    # Step 0 + 1: Exact cache tier first; on a miss, semantic tier while retrieving schema
+    with span("context"):
+        session_id, context = sessions.get(request.session_id)
+        enriched_question = context.build_context_prompt(question)
+        follow_up = bool(context.history)
+    cached, relevant_schema = search_exact(enriched_question), None
+    if cached is None:
+        cached, relevant_schema = await asyncio.gather(
+            asyncio.to_thread(search_similar, enriched_question, follow_up),
+            asyncio.to_thread(retrieve_schema, enriched_question),
+        )
     if cached:
-        sql, result = cached
-        explanation = explain_result(question, sql, result)
-        return {"sql": sql, "result": result, "explanation": explanation, "cached": True}
-
-    # Step 1: Build context
-    enriched_question = context.build_context_prompt(question)
+        sql, (json_result, ascii_result, *more) = cached
+        json_result, ascii_result, next_token = cached_page(sql, json_result, ascii_result, limit, *more)
+        (result_id, explanation), _ = await asyncio.gather(
+            explanation_for(question, sql, ascii_result, request.explain),
+            asyncio.to_thread(sessions.add_entry, session_id, question, sql, (json_result, ascii_result)),
+        )
+        log_query(question, sql, (json_result, ascii_result), cached=True, session_id=session_id,
+                  explanation=explanation)
+        return {"sql": sql, "json_result": json_result, "ascii_result": ascii_result,
+                "next_token": next_token, "explanation": explanation, "result_id": result_id,
+                "cached": True, "session_id": session_id}
 
     # Step 2: Generate SQL
-    sql = nl_to_sql(enriched_question, retriever)
+    with span("generate"):
+        sql = await nl_to_sql_async(enriched_question, retriever, relevant_schema=relevant_schema, stats=stats)
+
+    # Step 3: Validate locally (deterministic fixes before any LLM repair)
+    sql, error = await asyncio.to_thread(prepare, sql)
 
-    # Step 3: Run SQL
-    result = run_sql(cursor, sql)
+    # Step 4: Run SQL (first page only)
+    if error is None:
+        json_result, ascii_result, next_token = await asyncio.to_thread(execute, sql, limit)
+    else:
+        json_result, ascii_result, next_token = [], f"❌ Error running SQL: {error}", None
 
-    # Step 4: Repair if needed
-    if result.startswith("❌ Error"):
-        fixed_sql = repair_sql(question, sql, result, schema_info)
-        result = run_sql(cursor, fixed_sql)
+    # Step 5: Repair if needed
+    if ascii_result.startswith("❌ Error"):
+        with span("repair"):
+            fixed_sql = await repair_sql_async(question, sql, ascii_result, schema_info)
+        fixed_sql, _ = await asyncio.to_thread(prepare, fixed_sql)
+        json_result, ascii_result, next_token = await asyncio.to_thread(execute, fixed_sql, limit)
         sql = fixed_sql
 
-    # Step 5: Explanation
-    explanation = explain_result(question, sql, result)
+    # Step 6 + 7: Explanation, overlapped with Cache + Context, then Log
+    (result_id, explanation), _ = await asyncio.gather(
+        explanation_for(question, sql, ascii_result, request.explain),
+        asyncio.to_thread(remember, session_id, question, enriched_question, sql, (json_result, ascii_result),
+                          next_token, limit),
+    )
+    log_query(question, sql, (json_result, ascii_result), cached=False, session_id=session_id,
+              explanation=explanation)
+
+    return {"sql": sql, "json_result": json_result, "ascii_result": ascii_result,
+            "next_token": next_token, "explanation": explanation, "result_id": result_id,
+            "cached": False, "session_id": session_id}
+
+@app.get("/page")
+async def page(token: str, page_size: int = SQL_MAX_ROWS):
+    """Next page of an earlier result, from the `next_token` it returned."""
+    try:
+        sql, offset = parse_page_token(token)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid page token")
+    json_result, ascii_result, next_token = await asyncio.to_thread(
+        execute, sql, page_limit(page_size), offset)
+    return {"sql": sql, "json_result": json_result, "ascii_result": ascii_result,
+            "next_token": next_token}
+
+@app.get("/explain/{result_id}")
+async def explain(result_id: str):
+    """Explanation for an earlier /ask result (computed now if it was skipped)."""
+    explanation = cache.explanations.get(result_id)
+    if explanation is None:
+        inputs = cache.explanations.inputs(result_id)
+        if inputs is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired result_id")
+        _, explanation = await explanation_for(*inputs)
+    return {"result_id": result_id, "explanation": explanation}
+
+# --- Streaming: SQL first, rows next, explanation last ---
+def event(kind, **data):
+    return json.dumps({"type": kind, **data}, default=str) + "\n"
+
+def page_events(json_result, next_token):
+    """Row chunks (and the continuation token) of an already materialised page."""
+    for i in range(0, len(json_result), STREAM_CHUNK_ROWS):
+        yield event("rows", rows=json_result[i:i + STREAM_CHUNK_ROWS])
+    if next_token:
+        yield event("more", next_token=next_token)
+
+def cached_result(sql, limit):
+    """
+    (versions, page) from the result cache for a first page of `sql`: the
+    cached page or None, and the snapshot to put() a freshly fetched one under.
+    """
+    versions = results.snapshot(sql)
+    return versions, (results.get(sql, limit) if versions is not None else None)
+
+async def stream_answer(question, explain=True, limit=SQL_MAX_ROWS, session_id=None):
+    """
+    NDJSON events for /ask/stream. Headers are already sent when the
+    pipeline runs, so any failure (LLM errors after retries, a busy pool,
+    a fetch over budget) ends the stream with an {"type": "error"} event.
+    """
+    try:
+        async for chunk in answer_events(question, explain, limit, session_id):
+            yield chunk
+    except Exception as e:
+        print(f"[STREAM] ❌ {type(e).__name__}: {e}")
+        yield event("error", error=f"❌ Error: {e}")
+
+async def answer_events(question, explain, limit, session_id):
+    with span("context"):
+        session_id, context = sessions.get(session_id)
+        enriched_question = context.build_context_prompt(question)
+        follow_up = bool(context.history)
+    yield event("session", session_id=session_id)
+    cached, relevant_schema = search_exact(enriched_question), None
+    if cached is None:
+        cached, relevant_schema = await asyncio.gather(
+            asyncio.to_thread(search_similar, enriched_question, follow_up),
+            asyncio.to_thread(retrieve_schema, enriched_question),
+        )
+    if cached:
+        sql, (json_result, ascii_result, *more) = cached
+        yield event("sql", sql=sql, cached=True)
+        json_result, ascii_result, next_token = cached_page(sql, json_result, ascii_result, limit, *more)
+        for chunk in page_events(json_result, next_token):
+            yield chunk
+        (result_id, explanation), _ = await asyncio.gather(
+            explanation_for(question, sql, ascii_result, explain),
+            asyncio.to_thread(sessions.add_entry, session_id, question, sql, (json_result, ascii_result)),
+        )
+        yield event("explanation", explanation=explanation, result_id=result_id)
+        log_query(question, sql, (json_result, ascii_result), cached=True, session_id=session_id,
+                  explanation=explanation)
+        return
+
+    with span("generate"):
+        sql = await nl_to_sql_async(enriched_question, retriever, relevant_schema=relevant_schema, stats=stats)
+    sql, error = await asyncio.to_thread(prepare, sql)
+    yield event("sql", sql=sql, cached=False)
+
+    # Same result cache as execute(): an unchanged query over unchanged tables is not run again.
+    # The execute stage is the lookup plus time inside SQLite, not time spent waiting on the client.
+    sql_seconds, versions, page = 0.0, None, None
+    if error is None:
+        start = time.perf_counter()
+        versions, page = await asyncio.to_thread(cached_result, sql, limit)
+        sql_seconds = time.perf_counter() - start
+    if page is not None:
+        metrics.record("execute", sql_seconds)
+        json_result, ascii_result, next_token = page
+        for chunk in page_events(json_result, next_token):
+            yield chunk
+    else:
+        # One pooled connection is held while rows stream out (acquire times out rather than queue forever)
+        conn = await asyncio.to_thread(pool.acquire)
+        guard = budget.guard(conn)
+        try:
+            cursor = conn.cursor()
+            try:
+                if error:
+                    raise sqlite3.OperationalError(error)
+                columns = await asyncio.to_thread(guard.execute, cursor, sql)
+            except Exception as e:
+                with span("repair"):
+                    sql = await repair_sql_async(question, sql, guard.error_message(e), schema_info)
+                sql, _ = await asyncio.to_thread(prepare, sql, conn)
+                yield event("sql", sql=sql, cached=False, repaired=True)
+                versions = await asyncio.to_thread(results.snapshot, sql)
+                sql_seconds += guard.elapsed
+                guard = budget.guard(conn)
+                try:
+                    columns = await asyncio.to_thread(guard.execute, cursor, sql)
+                except Exception as e:
+                    yield event("error", error=guard.error_message(e))
+                    return
+
+            rows = []
+            while len(rows) < limit:
+                try:
+                    chunk = await asyncio.to_thread(guard.fetch, cursor, min(STREAM_CHUNK_ROWS, limit - len(rows)))
+                except Exception as e:
+                    yield event("error", error=guard.error_message(e))
+                    return
+                if not chunk:
+                    break
+                rows.extend(chunk)
+                yield event("rows", rows=[dict(zip(columns, row)) for row in chunk])
+
+            # Row cap reached: hand out a continuation token if anything is left
+            next_token = None
+            if len(rows) >= limit and await asyncio.to_thread(guard.fetch, cursor, 1):
+                next_token = make_page_token(sql, limit)
+                yield event("more", next_token=next_token)
+            cursor.close()
+        finally:
+            pool.release(conn)
+            metrics.record("execute", sql_seconds + guard.elapsed)
+
+        json_result, ascii_result = format_result(columns, rows)
+        await asyncio.to_thread(results.put, sql, limit, 0, (json_result, ascii_result, next_token), versions)
+
+    (result_id, explanation), _ = await asyncio.gather(
+        explanation_for(question, sql, ascii_result, explain),
+        asyncio.to_thread(remember, session_id, question, enriched_question, sql, (json_result, ascii_result),
+                          next_token, limit),
+    )
+    yield event("explanation", explanation=explanation, result_id=result_id)
+    log_query(question, sql, (json_result, ascii_result), cached=False, session_id=session_id,
+              explanation=explanation)
 
-    # Step 6: Log + Cache + Context
-    log_query(question, sql, result + "\nExplanation: " + explanation)
-    cache.add(question, sql, result)
-    context.add_entry(question, sql, result)
+@app.post("/ask/stream")
+async def ask_stream(request: QueryRequest):
+    """
+    Same pipeline as /ask, streamed as NDJSON events:
+    {"type": "session"} with the session_id first,
+    {"type": "sql"} as soon as it is generated, {"type": "rows"} chunks as
+    they are fetched (up to page_size rows, then {"type": "more"} with a
+    next_token for /page), then {"type": "explanation"} (or {"type": "error"}).
+    """
+    return StreamingResponse(stream_answer(request.question, request.explain, page_limit(request.page_size),
+                                           request.session_id),
+                             media_type="application/x-ndjson")
 
-    return {"sql": sql, "result": result, "explanation": explanation, "cached": False}
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus scrape endpoint: stage latency histograms, cache/repair/LLM counters."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,395 @@
+"""
+Micro-benchmarks for the NL2SQL hot paths.
+
+Usage:
+    python benchmark.py cache [--sizes 1000 10000 50000]
+    python benchmark.py embed [--clients 1 8 32] [--requests 256]
+    python benchmark.py retriever [--tables 10 1000 10000] [--columns 20]
+    python benchmark.py context [--turns 3 10] [--rows 10 200 1000]
+    python benchmark.py pipeline [--rows 1000 100000] [--queries 200] [--concurrency 4]
+                                 [--llm-latency-ms 300] [--compare bench_results/<file>.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+EMB_DIM = 384   # all-MiniLM-L6-v2
+
+
+def quiet():
+    """Silence the [CACHE ...] prints while timing."""
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+# ----------------------------
+# QueryCache.add
+# ----------------------------
+def bench_cache_add(sizes, probe=200):
+    """
+    Time QueryCache.add as the cache grows, and on a cache already full at
+    max_entries (every add then evicts the LRU entry). Embeddings are passed
+    in precomputed (as they are after a search miss), so this measures the
+    cache's own bookkeeping: both should stay flat as the cache grows.
+    """
+    from cache_manager import QueryCache
+
+    rng = np.random.default_rng(0)
+    result = ([{"n": 1}], "| n |")
+
+    def timed_adds(cache, target):
+        with quiet():
+            # Fill up to the target size untimed
+            while len(cache.entries) < target:
+                cache.add(f"q{cache._next_id}", "SELECT 1;", result,
+                          embedding=rng.random(EMB_DIM, dtype="float32"))
+            timings = []
+            for _ in range(probe):
+                emb = rng.random(EMB_DIM, dtype="float32")
+                start = time.perf_counter()
+                cache.add(f"q{cache._next_id}", "SELECT 1;", result, embedding=emb)
+                timings.append(time.perf_counter() - start)
+        return np.mean(timings) * 1e6, np.max(timings) * 1e6
+
+    growing = QueryCache()
+    print(f"{'entries':>10} | {'add µs (mean)':>14} | {'add µs (max)':>13} | "
+          f"{'full µs (mean)':>15} | {'full µs (max)':>14}")
+    print("-" * 79)
+    for target in sizes:
+        grow_mean, grow_max = timed_adds(growing, target - probe)
+        full_mean, full_max = timed_adds(QueryCache(max_entries=target), target)
+        print(f"{target:>10} | {grow_mean:>14.1f} | {grow_max:>13.1f} | {full_mean:>15.1f} | {full_max:>14.1f}")
+
+
+# ----------------------------
+# Embedding micro-batching
+# ----------------------------
+def bench_embed(clients, requests, max_batch=32, max_wait_ms=2):
+    """
+    Encode `requests` distinct questions from N concurrent clients, one
+    question per call (as /ask does), with and without micro-batching.
+    """
+    from embeddings import Embedder
+
+    unbatched = Embedder(max_batch_size=1)
+    batched = Embedder(max_batch_size=max_batch, max_wait_ms=max_wait_ms)
+    batched._model = unbatched.model   # share the loaded model; load time is not measured
+    unbatched.encode(["warm up"], memo=False)
+
+    print(f"{'clients':>8} | {'unbatched q/s':>14} | {'batched q/s':>12} | {'speedup':>8}")
+    print("-" * 52)
+    for n in clients:
+        rates = []
+        for run, embedder in enumerate((unbatched, batched)):
+            # Fresh texts per run so the memo never answers
+            texts = [f"show orders for customer {run}-{n}-{i} placed last month" for i in range(requests)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n) as pool:
+                list(pool.map(lambda t: embedder.encode([t]), texts))
+            rates.append(requests / (time.perf_counter() - start))
+        print(f"{n:>8} | {rates[0]:>14.1f} | {rates[1]:>12.1f} | {rates[1] / rates[0]:>7.2f}x")
+
+
+# ----------------------------
+# Schema retrieval at scale
+# ----------------------------
+class HashingEmbedder:
+    """
+    Stand-in for the sentence model: bag of hashed words, so texts sharing
+    words land close together. Lets large synthetic schemas be indexed in
+    seconds; the real model adds a constant per-query encode cost on top.
+    """
+
+    def __init__(self, dim=EMB_DIM):
+        self.dim = dim
+        self.words = {}
+
+    def _word(self, w):
+        if w not in self.words:
+            seed = int.from_bytes(w.encode()[:8].ljust(8, b"\0"), "little") ^ len(w)
+            self.words[w] = np.random.default_rng(seed).standard_normal(self.dim).astype("float32")
+        return self.words[w]
+
+    def encode(self, texts, memo=True):
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for i, text in enumerate(texts):
+            for w in re.findall(r"[a-z0-9]+", text.lower()):
+                out[i] += self._word(w)
+        return out
+
+
+def synthetic_tables(n_tables, n_columns, seed=0):
+    """Warehouse-like schema: each table has an id, a few FKs to earlier tables and filler columns."""
+    rng = np.random.default_rng(seed)
+    topics = ["customer", "order", "product", "invoice", "shipment", "supplier", "employee",
+              "store", "payment", "refund", "campaign", "ticket", "account", "region", "contract"]
+    tables = {}
+    for t in range(n_tables):
+        name = f"{topics[t % len(topics)]}_{t}"
+        columns = [("id", "INTEGER")]
+        foreign_keys = []
+        for ref in rng.choice(t, size=min(t, 2), replace=False) if t else []:
+            ref_name = list(tables)[ref]
+            columns.append((f"{ref_name}_id", "INTEGER"))
+            foreign_keys.append((f"{ref_name}_id", ref_name, "id"))
+        while len(columns) < n_columns:
+            columns.append((f"{topics[rng.integers(len(topics))]}_attr_{len(columns)}", "TEXT"))
+        tables[name] = {"columns": columns, "foreign_keys": foreign_keys}
+    return tables
+
+
+def bench_retriever(table_counts, n_columns, queries=200):
+    """Build time, index type and retrieve() latency for synthetic schemas of growing size."""
+    from context_manager import estimate_tokens
+    from retriever import SchemaRetriever
+
+    embedder = HashingEmbedder()
+    print(f"{'tables':>7} | {'docs':>8} | {'index':>13} | {'build s':>8} | "
+          f"{'p50 ms':>7} | {'p95 ms':>7} | {'tokens':>6}")
+    print("-" * 74)
+    for n in table_counts:
+        tables = synthetic_tables(n, n_columns)
+        start = time.perf_counter()
+        retriever = SchemaRetriever([], tables=tables, embedder=embedder, cache_dir="")   # never the API's cache
+        build = time.perf_counter() - start
+
+        names = list(tables)
+        timings, tokens = [], []
+        for i in range(queries):
+            table = names[i * 7919 % len(names)]
+            column = tables[table]["columns"][-1][0]
+            query = f"total {column.replace('_', ' ')} per {table.split('_')[0]}"
+            start = time.perf_counter()
+            lines = retriever.retrieve(query)
+            timings.append(time.perf_counter() - start)
+            tokens.append(sum(estimate_tokens(l) for l in lines))
+
+        print(f"{n:>7} | {len(retriever.docs):>8} | {type(retriever.index).__name__:>13} | {build:>8.1f} | "
+              f"{np.percentile(timings, 50) * 1e3:>7.2f} | {np.percentile(timings, 95) * 1e3:>7.2f} | "
+              f"{int(np.mean(tokens)):>6}")
+
+
+# ----------------------------
+# Conversation context
+# ----------------------------
+def bench_context(turn_counts, row_counts, max_tokens=1000, repeat=200):
+    """
+    Follow-up prompt size and build time after N turns whose results have
+    R rows each: full results pasted (unbudgeted) vs. summarised + budgeted.
+    """
+    from tabulate import tabulate
+    from context_manager import ContextManager, estimate_tokens
+
+    print(f"{'turns':>5} | {'rows':>5} | {'full tok':>8} | {'budget tok':>10} | "
+          f"{'full µs':>8} | {'budget µs':>9} | {'smaller':>7}")
+    print("-" * 70)
+    for turns in turn_counts:
+        for n in row_counts:
+            rows = [{"id": i, "name": f"customer {i}", "city": "New York", "amount": i * 1.5,
+                     "order_date": "2024-02-20"} for i in range(n)]
+            result = (rows, tabulate([tuple(r.values()) for r in rows], headers=list(rows[0]), tablefmt="psql"))
+
+            sizes, times = [], []
+            for context in (ContextManager(), ContextManager(max_tokens=max_tokens)):
+                for t in range(turns):
+                    context.add_entry(f"question {t}", f"SELECT * FROM orders WHERE id > {t};", result)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    prompt = context.build_context_prompt("and only those from Boston?")
+                times.append((time.perf_counter() - start) / repeat)
+                sizes.append(estimate_tokens(prompt))
+
+            print(f"{turns:>5} | {n:>5} | {sizes[0]:>8} | {sizes[1]:>10} | {times[0] * 1e6:>8.1f} | "
+                  f"{times[1] * 1e6:>9.1f} | {sizes[0] / sizes[1]:>6.1f}x")
+
+
+# ----------------------------
+# Full pipeline on a synthetic database
+# ----------------------------
+# metrics.span names used by api.py, in pipeline order ("total" = whole request)
+STAGES = ["context", "cache_search", "retrieve", "generate", "validate", "execute",
+          "repair", "explain", "cache_add", "total"]
+
+# (question, canned SQL) templates; {city}/{product}/{year} vary per question.
+# Two carry mistakes on purpose: a typo the local validator fixes, and a
+# missing table that goes through LLM repair.
+PIPELINE_QUESTIONS = [
+    ("Total revenue per city for {year}",
+     "SELECT c.city, SUM(o.amount) AS revenue FROM orders o JOIN customers c ON c.id = o.customer_id "
+     "WHERE o.order_date LIKE '{year}%' GROUP BY c.city ORDER BY revenue DESC;"),
+    ("Top 10 customers from {city} by spend",
+     "SELECT c.name, SUM(o.amount) AS spent FROM orders o JOIN customers c ON c.id = o.customer_id "
+     "WHERE c.city = '{city}' GROUP BY c.id ORDER BY spent DESC LIMIT 10;"),
+    ("How many {product} orders were placed in {year}",
+     "SELECT COUNT(*) FROM orders WHERE product = '{product}' AND order_date LIKE '{year}%';"),
+    ("List customers who live in {city}",
+     "SELECT id, name, signup_date FROM customers WHERE city = '{city}';"),
+    ("Average {product} order amount per month of {year}",
+     "SELECT substr(order_date, 1, 7) AS month, AVG(amout) FROM orders "
+     "WHERE product = '{product}' AND order_date LIKE '{year}%' GROUP BY month;"),
+    ("Which suppliers ship {product} to {city}",
+     "SELECT s.name FROM suppliers s WHERE s.product = '{product}';"),
+]
+
+
+def pipeline_questions(n, seed=0):
+    """n (question, sql) pairs drawn from PIPELINE_QUESTIONS with random parameters."""
+    from seed_db import CITIES, PRODUCTS
+
+    rng = np.random.default_rng(seed)
+    cases = []
+    for i in range(n):
+        question, sql = PIPELINE_QUESTIONS[i % len(PIPELINE_QUESTIONS)]
+        params = {"city": CITIES[rng.integers(len(CITIES))], "product": PRODUCTS[rng.integers(len(PRODUCTS))],
+                  "year": str(2023 + rng.integers(2))}
+        cases.append((question.format(**params), sql.format(**params)))
+    return cases
+
+
+def parse_server_timing(header):
+    """{stage: ms} from a Server-Timing header ('retrieve;dur=1.2, generate;dur=310.5')."""
+    timings = {}
+    for part in filter(None, (p.strip() for p in (header or "").split(","))):
+        name, _, dur = part.partition(";dur=")
+        timings[name] = float(dur)
+    return timings
+
+
+def bench_pipeline(row_counts, queries, concurrency, llm_latency_ms, out_dir="bench_results", compare=None):
+    """
+    Send `queries` questions per database size through the real /ask
+    handler (api.py, via an in-process ASGI client, `concurrency` requests
+    in flight) with the offline stub LLM (fixed latency, canned SQL).
+    Stage timings come from the Server-Timing header, i.e. the same
+    metrics.span names /metrics reports. Prints p50/p95/p99 per stage (ms)
+    and throughput, and saves the results as JSON; --compare flags stages
+    that got slower than a saved run.
+    """
+    import asyncio
+    import importlib
+
+    import httpx
+
+    from llm_client import LLMClient, StubBackend, set_client
+    from seed_db import make_scaled_db
+
+    baseline = json.loads(Path(compare).read_text()) if compare else {}
+    report = {"timestamp": datetime.now().isoformat(timespec="seconds"), "queries": queries,
+              "concurrency": concurrency, "llm_latency_ms": llm_latency_ms, "runs": {}}
+
+    async def drive(app, cases):
+        slots = asyncio.Semaphore(concurrency)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            async def ask(question):
+                async with slots:
+                    response = await client.post("/ask", json={"question": question})
+                response.raise_for_status()
+                return parse_server_timing(response.headers.get("server-timing")), response.json()["cached"]
+
+            await ask(cases[0][0])   # warm-up: model loads, first queries
+            start = time.perf_counter()
+            results = await asyncio.gather(*(ask(question) for question, _ in cases))
+            return results, time.perf_counter() - start
+
+    api = None
+    for rows in row_counts:
+        db_path = Path(out_dir) / f"orders_{rows}.db"
+        if not db_path.exists():
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            start = time.perf_counter()
+            make_scaled_db(db_path, rows)
+            print(f"Generated {db_path} ({rows} orders) in {time.perf_counter() - start:.1f}s")
+
+        cases = pipeline_questions(queries)
+        set_client(LLMClient(backend=StubBackend(llm_latency_ms, {q.lower(): sql for q, sql in cases}),
+                             max_concurrency=concurrency))
+        # api.py is configured from the environment at import: fresh in-memory caches per database
+        os.environ.update(DB_PATH=db_path.as_posix(), DB_POOL_SIZE=str(concurrency), TIMING_HEADERS="true",
+                          QUERY_CACHE_DIR="", SCHEMA_CACHE_DIR="",
+                          QUERY_LOG_FILE=(Path(out_dir) / "bench_query_log.jsonl").as_posix())
+        with quiet():
+            api = importlib.reload(api) if api else importlib.import_module("api")
+            api.stats.refresh()   # column notes in the prompt, as after `python profiler.py`
+            results, wall = asyncio.run(drive(api.app, cases))
+        api.pool.close()
+
+        hits = sum(hit for _, hit in results)
+        summary = {"throughput_qps": queries / wall, "cache_hit_rate": hits / queries, "stages": {}}
+        for name in STAGES:
+            values = [t[name] for t, _ in results if name in t]
+            if values:
+                summary["stages"][name] = {"n": len(values), "mean": float(np.mean(values)),
+                                           **{f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}}
+        report["runs"][str(rows)] = summary
+
+        print(f"\n{rows} orders: {summary['throughput_qps']:.1f} q/s, cache hit rate {summary['cache_hit_rate']:.0%}")
+        base = baseline.get("runs", {}).get(str(rows), {}).get("stages", {})
+        print(f"{'stage':>12} | {'n':>5} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}" + (" | vs baseline p95" if base else ""))
+        print("-" * (52 + (18 if base else 0)))
+        for name, st in summary["stages"].items():
+            line = f"{name:>12} | {st['n']:>5} | {st['p50']:>8.2f} | {st['p95']:>8.2f} | {st['p99']:>8.2f}"
+            if name in base:
+                change = (st["p95"] - base[name]["p95"]) / max(base[name]["p95"], 1e-9)
+                line += f" | {change:+7.1%}" + ("  ⚠️ slower" if change > 0.10 and st["p95"] - base[name]["p95"] > 0.1 else "")
+            print(line)
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    out = Path(out_dir) / f"pipeline-{datetime.now():%Y%m%d-%H%M%S}.json"
+    out.write_text(json.dumps(report, indent=2))
+    print(f"\nSaved {out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NL2SQL micro-benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p_cache = sub.add_parser("cache", help="QueryCache.add cost vs. cache size, growing and full")
+    p_cache.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 50000])
+
+    p_embed = sub.add_parser("embed", help="Embedding throughput, 1 vs. N concurrent clients")
+    p_embed.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    p_embed.add_argument("--requests", type=int, default=256)
+    p_embed.add_argument("--max-batch", type=int, default=32)
+    p_embed.add_argument("--max-wait-ms", type=float, default=2)
+
+    p_retr = sub.add_parser("retriever", help="Schema retrieval latency vs. number of tables")
+    p_retr.add_argument("--tables", type=int, nargs="+", default=[10, 1000, 10000])
+    p_retr.add_argument("--columns", type=int, default=20)
+
+    p_ctx = sub.add_parser("context", help="Follow-up prompt size: full vs. budgeted context")
+    p_ctx.add_argument("--turns", type=int, nargs="+", default=[3, 10])
+    p_ctx.add_argument("--rows", type=int, nargs="+", default=[10, 200, 1000])
+    p_ctx.add_argument("--max-tokens", type=int, default=1000)
+
+    p_pipe = sub.add_parser("pipeline", help="Per-stage latency of the full pipeline on synthetic data")
+    p_pipe.add_argument("--rows", type=int, nargs="+", default=[1000, 100000],
+                        help="orders per database (customers = rows / 10); up to 10M")
+    p_pipe.add_argument("--queries", type=int, default=200)
+    p_pipe.add_argument("--concurrency", type=int, default=4)
+    p_pipe.add_argument("--llm-latency-ms", type=float, default=300, help="simulated LLM latency per call")
+    p_pipe.add_argument("--out-dir", default="bench_results")
+    p_pipe.add_argument("--compare", help="earlier results JSON to compare against")
+
+    args = parser.parse_args()
+    if args.bench == "cache":
+        bench_cache_add(args.sizes)
+    elif args.bench == "embed":
+        bench_embed(args.clients, args.requests, args.max_batch, args.max_wait_ms)
+    elif args.bench == "retriever":
+        bench_retriever(args.tables, args.columns)
+    elif args.bench == "context":
+        bench_context(args.turns, args.rows, args.max_tokens)
+    elif args.bench == "pipeline":
+        bench_pipeline(args.rows, args.queries, args.concurrency, args.llm_latency_ms, args.out_dir, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,789 @@
-from sentence_transformers import SentenceTransformer
+import atexit
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
 import faiss
 import numpy as np
 
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+import metrics
+from embeddings import get_embedder
+
+
+class CacheStoreLocked(RuntimeError):
+    """The store directory is already in use by another process."""
+
+
+def _try_lock(fh):
+    """Non-blocking exclusive lock on an open file; False if another process holds it."""
+    try:
+        if fcntl:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+class CacheStore:
+    """
+    Disk backing for QueryCache.
+
+    - embeddings*.f32 : raw float32 vectors, appended in write order
+                        (memory-mapped on load, never re-encoded)
+    - entries.db      : SQLite table of entries by id, each with the row
+                        of its vector in the file
+
+    Writes go through a background thread so add() never waits on disk.
+    Evicted entries leave dead vector rows behind; once they outnumber the
+    live ones (and at least COMPACT_MIN_DEAD), the writer thread rewrites
+    the file with live rows only. Entry ids never change. Ids are allocated
+    in memory, so a directory has a single writer: the first process takes
+    `.lock`, and any other raises CacheStoreLocked.
+    """
+
+    COMPACT_MIN_DEAD = 1000
+
+    ENTRY_COLUMNS = {
+        "id": "INTEGER PRIMARY KEY",
+        "enriched": "TEXT",
+        "sql": "TEXT",
+        "json_result": "TEXT",
+        "ascii_result": "TEXT",
+        "created": "REAL",
+        "tables": "TEXT",
+        "versions": "TEXT",
+        "more": "INTEGER",
+        "vector_row": "INTEGER",   # NULL in stores written before compaction: the row is the id
+    }
+
+    def __init__(self, directory):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.dir / ".lock", "a+")
+        if not _try_lock(self._lock_file):
+            self._lock_file.close()
+            raise CacheStoreLocked(f"{self.dir} is in use by another process")
+        self.db_path = self.dir / "entries.db"
+
+        conn = sqlite3.connect(self.db_path)
+        columns = ", ".join(f"{name} {kind}" for name, kind in self.ENTRY_COLUMNS.items())
+        conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS explanations (result_id TEXT PRIMARY KEY, explanation TEXT);
+        CREATE TABLE IF NOT EXISTS entries ({columns});
+        """)
+        # Stores written before eviction support lack the newer columns
+        existing = {r[1] for r in conn.execute("PRAGMA table_info(entries);")}
+        for name, kind in self.ENTRY_COLUMNS.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE entries ADD COLUMN {name} {kind};")
+        conn.commit()
+        meta = dict(conn.execute("SELECT key, value FROM meta;").fetchall())
+        max_id = conn.execute("SELECT MAX(id) FROM entries;").fetchone()[0]
+
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        self.emb_path = self.dir / meta.get("emb_file", "embeddings.f32")
+        self._rows = self._file_rows()   # vector rows in the file; only the writer thread appends
+        # Older stores numbered ids by file row and kept no next_id
+        self.next_id = max(int(meta.get("next_id", self._rows)), (max_id or -1) + 1)
+        self._compact(conn)   # rows left dead by the previous run, before anything reads the file
+        conn.close()
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="cache-store-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _file_rows(self):
+        if not self.dim or not self.emb_path.exists():
+            return 0
+        return self.emb_path.stat().st_size // (4 * self.dim)
+
+    def load(self):
+        """
+        Return (entries, embeddings) for everything on disk.
+        entries carry their store id; embeddings is an (n, dim) float32 array.
+        """
+        rows_on_disk = self._file_rows()
+        if not rows_on_disk:
+            return [], None
+
+        # A crash between the two writes can leave a vector without an entry,
+        # never the reverse, so only rows inside the file are trusted.
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT id, enriched, sql, json_result, ascii_result, created, tables, versions, more, "
+            "COALESCE(vector_row, id) FROM entries WHERE COALESCE(vector_row, id) < ? ORDER BY id",
+            (rows_on_disk,),
+        ).fetchall()
+        conn.close()
+        if not rows:
+            return [], None
+
+        mm = np.memmap(self.emb_path, dtype="float32", mode="r", shape=(rows_on_disk, self.dim))
+        vector_rows = np.fromiter((r[9] for r in rows), dtype="int64", count=len(rows))
+        embeddings = np.ascontiguousarray(mm[vector_rows])
+        del mm
+
+        entries = [{
+            "id": r[0],
+            "enriched": r[1],
+            "sql": r[2],
+            "json_result": json.loads(r[3]),
+            "ascii_result": r[4],
+            "created": r[5] or time.time(),
+            "tables": json.loads(r[6]) if r[6] else [],
+            "versions": json.loads(r[7]) if r[7] else {},
+            "more": None if r[8] is None else bool(r[8]),
+        } for r in rows]
+        return entries, embeddings
+
+    @property
+    def dead_rows(self):
+        """Vectors on disk whose entries were evicted."""
+        conn = sqlite3.connect(self.db_path)
+        live = conn.execute("SELECT COUNT(*) FROM entries;").fetchone()[0]
+        conn.close()
+        return self._file_rows() - live
+
+    def append(self, entry, embedding):
+        """Queue an entry for writing; returns its store id."""
+        if self.dim is None:
+            self.dim = embedding.shape[-1]
+        entry_id = self.next_id
+        self.next_id += 1
+        self._queue.put(("add", entry_id, entry, np.asarray(embedding, dtype="float32").reshape(-1)))
+        return entry_id
+
+    def delete(self, entry_id):
+        """Queue removal of an entry (its vector row is reclaimed by compaction)."""
+        self._queue.put(("del", entry_id))
+
+    def put_explanation(self, result_id, explanation):
+        self._queue.put(("expl", result_id, explanation))
+
+    def load_explanations(self, limit):
+        """Most recent `limit` explanations as {result_id: explanation}, oldest first."""
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT result_id, explanation FROM explanations ORDER BY rowid DESC LIMIT ?", (limit,)
+        ).fetchall()
+        conn.close()
+        return dict(reversed(rows))
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.db_path)
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            # Drain whatever else is pending so bursts become one commit
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            ops = [b for b in batch if b is not None]
+            if ops:
+                try:
+                    self._write(conn, ops)
+                except Exception as e:
+                    print(f"[CACHE STORE] Write failed: {e}")
+            for _ in batch:
+                self._queue.task_done()
+            if None in batch:
+                conn.close()
+                return
+
+    @staticmethod
+    def _row(entry_id, e):
+        return (entry_id, e["enriched"], e["sql"], json.dumps(e["json_result"], default=str),
+                e["ascii_result"], e.get("created", time.time()),
+                json.dumps(e.get("tables", [])), json.dumps(e.get("versions", {})), e.get("more"))
+
+    def _write(self, conn, ops):
+        adds = [op for op in ops if op[0] == "add"]
+        rows = {}
+        if adds:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)", (str(self.dim),))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)",
+                         (str(max(op[1] for op in adds) + 1),))
+            # Vectors first: an entry is only ever visible once its vector is on disk
+            with open(self.emb_path, "ab") as f:
+                f.truncate(self._rows * 4 * self.dim)   # drop a partial row left by a crash
+                for _, entry_id, _, emb in adds:
+                    f.write(emb.tobytes())
+                    rows[entry_id] = self._rows
+                    self._rows += 1
+
+        # Apply in queue order so an add followed by its eviction ends deleted
+        for op in ops:
+            if op[0] == "expl":
+                conn.execute("INSERT OR REPLACE INTO explanations (result_id, explanation) VALUES (?, ?)", op[1:])
+            elif op[0] == "add":
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries "
+                    "(id, enriched, sql, json_result, ascii_result, created, tables, versions, more, vector_row) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._row(op[1], op[2]) + (rows[op[1]],),
+                )
+            elif op[0] == "del":
+                conn.execute("DELETE FROM entries WHERE id = ?", (op[1],))
+        conn.commit()
+
+        if any(op[0] == "del" for op in ops):
+            self._compact(conn)
+
+    def _compact(self, conn):
+        """
+        Rewrite the vector file with live rows only, once dead rows outnumber
+        them. The new file is switched in by the same transaction that moves
+        the entries' rows, so a crash leaves either the old or new store.
+        """
+        live = conn.execute("SELECT COUNT(*) FROM entries;").fetchone()[0]
+        if not self.dim or self._rows - live <= max(live, self.COMPACT_MIN_DEAD):
+            return
+        entries = conn.execute(
+            "SELECT id, COALESCE(vector_row, id) FROM entries WHERE COALESCE(vector_row, id) < ? ORDER BY id", (self._rows,)
+        ).fetchall()
+
+        old_path = self.emb_path
+        generation = int(old_path.stem.rpartition(".")[2] or 0) if "." in old_path.stem else 0
+        new_path = self.dir / f"embeddings.{generation + 1}.f32"
+        mm = np.memmap(old_path, dtype="float32", mode="r", shape=(self._rows, self.dim))
+        np.ascontiguousarray(mm[[row for _, row in entries]]).tofile(new_path)
+        del mm
+
+        with conn:
+            conn.execute("DELETE FROM entries WHERE COALESCE(vector_row, id) >= ?", (self._rows,))
+            conn.executemany("UPDATE entries SET vector_row = ? WHERE id = ?",
+                             [(new_row, entry_id) for new_row, (entry_id, _) in enumerate(entries)])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('emb_file', ?)", (new_path.name,))
+        old_path.unlink(missing_ok=True)
+        print(f"[CACHE STORE] Compacted {self._rows} vector rows to {len(entries)}")
+        self.emb_path = new_path
+        self._rows = len(entries)
+
+    def flush(self):
+        """Block until every queued write is on disk."""
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._lock_file.close()   # releases the directory lock
+
+
+def normalize_question(text):
+    """Lowercase, drop punctuation, collapse whitespace."""
+    text = re.sub(r"[^a-z0-9\s]", "", text.lower())
+    return " ".join(text.split())
+
+
+def question_key(text):
+    """
+    Exact-match cache key: hash of the (enriched) question with only case,
+    whitespace and trailing punctuation normalized, so operators, signs and
+    non-Latin letters still tell questions apart. None for a blank question.
+    """
+    text = " ".join((text or "").casefold().split()).rstrip("?.!;, ")
+    if not text:
+        return None
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+SQL_TOKEN = re.compile(r"""
+    '(?:[^']|'')*'                                   # string literal
+  | "(?:[^"]|"")*"                                   # quoted identifier
+  | --[^\n]* | /\*.*?\*/                             # comments
+  | (?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?             # number
+  | [A-Za-z_][A-Za-z0-9_$]*                          # keyword / identifier
+  | <>|!=|<=|>=|==|\|\|
+  | \S
+""", re.S | re.X)
+
+
+def canonical_sql(sql):
+    """
+    SQL text with formatting differences removed: comments dropped,
+    whitespace collapsed, keywords and bare identifiers lowercased, numbers
+    written one way (007 -> 7, 1.50 -> 1.5), trailing semicolons dropped.
+    String literals and quoted identifiers are kept verbatim, since their
+    values change the result.
+    """
+    tokens = []
+    for tok in SQL_TOKEN.findall(sql or ""):
+        if tok.startswith(("--", "/*")):
+            continue
+        if tok[0].isdigit() or (tok[0] == "." and len(tok) > 1):
+            tok = repr(float(tok)) if any(c in tok for c in ".eE") else str(int(tok))
+        elif tok[0] not in "'\"":
+            tok = tok.lower()
+        tokens.append(tok)
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
+
+
+class ExplanationCache:
+    """
+    Explanations memoised by (normalized question, SQL, result hash), so a
+    cached answer does not pay another Gemini round trip. Inputs of
+    results that were not explained yet are kept too, so the explanation
+    can be produced later by result id.
+    """
+
+    def __init__(self, max_entries=10000, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self.explanations = OrderedDict()   # result_id -> explanation
+        self.pending = OrderedDict()        # result_id -> (question, sql, result_text)
+        self.lock = threading.Lock()
+        if store:
+            self.explanations.update(store.load_explanations(max_entries))
+
+    @staticmethod
+    def result_id(question, sql, result_text):
+        result_hash = hashlib.sha256((result_text or "").encode()).hexdigest()
+        key = "\x1f".join([normalize_question(question), " ".join((sql or "").split()), result_hash])
+        return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+    def lookup(self, question, sql, result_text):
+        """
+        Returns (result_id, explanation or None). On a miss the inputs are
+        remembered so explain_later(result_id) can be served afterwards.
+        """
+        result_id = self.result_id(question, sql, result_text)
+        with self.lock:
+            if result_id in self.explanations:
+                self.explanations.move_to_end(result_id)
+                return result_id, self.explanations[result_id]
+            self.pending[result_id] = (question, sql, result_text)
+            self.pending.move_to_end(result_id)
+            while len(self.pending) > self.max_entries:
+                self.pending.popitem(last=False)
+        return result_id, None
+
+    def get(self, result_id):
+        with self.lock:
+            return self.explanations.get(result_id)
+
+    def inputs(self, result_id):
+        """(question, sql, result_text) of a result awaiting explanation, or None."""
+        with self.lock:
+            return self.pending.get(result_id)
+
+    def put(self, result_id, explanation):
+        with self.lock:
+            self.explanations[result_id] = explanation
+            self.explanations.move_to_end(result_id)
+            self.pending.pop(result_id, None)
+            while len(self.explanations) > self.max_entries:
+                self.explanations.popitem(last=False)
+        if self.store:
+            self.store.put_explanation(result_id, explanation)
+
+
 class QueryCache:
-    def __init__(self):
-        self.model = SentenceTransformer("all-MiniLM-L6-v2")
-        self.queries = []     # Stores enriched queries
-        self.entries = []     # Stores dicts with SQL + results
-        self.index = None
+    """
+    Two-tier question cache. search() first looks the normalized question
+    up in a hash map (exact repeats: no model call), and only on a miss
+    embeds it and searches the FAISS index for a paraphrase. Lookups are
+    counted per tier in nl2sql_cache_lookups_total.
+    """
+
+    def __init__(self, persist_dir=None, max_entries=None, max_bytes=None, ttl=None, tracker=None):
+        """
+        persist_dir = optional directory for a disk-backed cache; entries and
+                      their embeddings are reloaded from it at startup. One
+                      process owns a directory; others cache in memory.
+        max_entries = evict least-recently-used entries beyond this count
+        max_bytes   = ... or beyond this approximate size (results + vectors)
+        ttl         = seconds after which an entry is no longer served
+        tracker     = optional db.ChangeTracker; entries whose SQL touches a
+                      table modified since they were cached are invalidated
+        """
+        self.embedder = get_embedder()
+        self.entries = OrderedDict()   # id -> dict with SQL + results, in LRU order
+        self.vectors = {}              # id -> embedding, kept so the index never needs re-encoding
+        self.exact = {}                # question_key -> id (newest entry for that question)
+        self.index = None              # FAISS index over self.vectors, keyed by entry id
+        self.lock = threading.RLock()
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.tracker = tracker
+        self.nbytes = 0
+        self._next_id = 0
+        self._last_purge = time.time()
+
+        self.store = None
+        if persist_dir:
+            try:
+                self.store = CacheStore(persist_dir)
+            except CacheStoreLocked as e:
+                # e.g. a second API worker: serve from memory rather than corrupt ids on disk
+                print(f"[CACHE STORE] ⚠️ {e}; this process keeps an in-memory cache (set QUERY_CACHE_DIR per worker)")
+        if self.store:
+            self._load()
+        self.explanations = ExplanationCache(max_entries=max_entries or 10000, store=self.store)
+
+    @classmethod
+    def from_env(cls, tracker=None):
+        """
+        Build a cache configured from environment variables:
+        QUERY_CACHE_DIR, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL_SECONDS
+        (an empty value disables that option).
+        """
+        def env(name, default, cast):
+            value = os.getenv(name, default)
+            return cast(value) if value else None
+
+        return cls(
+            persist_dir=env("QUERY_CACHE_DIR", "query_cache", str),
+            max_entries=env("CACHE_MAX_ENTRIES", "10000", int),
+            max_bytes=env("CACHE_MAX_BYTES", str(256 * 1024 * 1024), int),
+            ttl=env("CACHE_TTL_SECONDS", "86400", float),
+            tracker=tracker,
+        )
+
+    @property
+    def queries(self):
+        """Cached (enriched) questions, least recently used first."""
+        return [e["enriched"] for e in self.entries.values()]
+
+    @property
+    def embeddings(self):
+        """Stored query embeddings as an (n, dim) float32 matrix, in entry order."""
+        if not self.vectors:
+            return np.zeros((0, 0), dtype="float32")
+        return np.stack([self.vectors[i] for i in self.entries])
+
+    def _load(self):
+        entries, embeddings = self.store.load()
+        if not entries:
+            return
+        versions = self.tracker.versions() if self.tracker else None
+        for entry, emb in zip(entries, embeddings):
+            if self._is_stale(entry, versions):
+                self.store.delete(entry["id"])
+            else:
+                self._insert(entry["id"], entry, emb)
+        self._enforce_limits()
+        self._rebuild_index()
+        print(f"[CACHE LOAD] {len(self.entries)} entries from {self.store.dir}")
+
+    def _encode(self, text):
+        return self.embedder.encode([text])
+
+    @staticmethod
+    def _entry_size(entry, emb):
+        return (emb.nbytes + len(entry["enriched"]) + len(entry["sql"] or "")
+                + len(entry["ascii_result"] or "")
+                + len(json.dumps(entry["json_result"], default=str)))
+
+    def _insert(self, entry_id, entry, emb):
+        entry["size"] = self._entry_size(entry, emb)
+        entry["key"] = question_key(entry["enriched"])
+        self.entries[entry_id] = entry
+        self.vectors[entry_id] = emb
+        if entry["key"]:
+            self.exact[entry["key"]] = entry_id
+        self.nbytes += entry["size"]
+        self._next_id = max(self._next_id, entry_id + 1)
 
     def _rebuild_index(self):
-        """Rebuild FAISS index whenever a new query is added."""
-        if not self.queries:
+        """Rebuild FAISS index from the stored embeddings (no re-encoding)."""
+        if not self.vectors:
             self.index = None
             return
-        embeddings = self.model.encode(self.queries).astype("float32")
-        self.index = faiss.IndexFlatL2(embeddings.shape[1])
-        self.index.add(embeddings)
+        ids = np.fromiter(self.entries.keys(), dtype="int64", count=len(self.entries))
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(len(next(iter(self.vectors.values())))))
+        self.index.add_with_ids(self.embeddings, ids)
+
+    def _evict(self, entry_id, reason):
+        entry = self.entries.pop(entry_id)
+        self.vectors.pop(entry_id)
+        if entry["key"] and self.exact.get(entry["key"]) == entry_id:
+            del self.exact[entry["key"]]
+        self.nbytes -= entry["size"]
+        # The vector stays in the index as a tombstone (remove_ids compacts the
+        # whole flat index); searches skip it, and the index is rebuilt once
+        # tombstones outnumber live entries, so eviction stays O(1) amortized.
+        if self.index is not None and self.index.ntotal - len(self.entries) > len(self.entries):
+            self._rebuild_index()
+        if self.store:
+            self.store.delete(entry_id)
+        print(f"[CACHE EVICT] ({reason}) {entry['enriched'][:60]}...")
 
-    def add(self, enriched_question, sql, result_tuple):
+    def _is_stale(self, entry, versions=None):
+        """Reason the entry must not be served any more, or None."""
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            return "ttl"
+        if self.tracker and entry.get("tables"):
+            current = versions if versions is not None else self.tracker.versions()
+            if any(current.get(t) != entry["versions"].get(t) for t in entry["tables"]):
+                return "data changed"
+        return None
+
+    def _enforce_limits(self):
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            self._evict(next(iter(self.entries)), "lru")
+
+    def purge(self):
+        """Drop every expired or invalidated entry."""
+        with self.lock:
+            versions = self.tracker.versions() if self.tracker else None
+            stale = [(i, self._is_stale(e, versions)) for i, e in self.entries.items()]
+            for entry_id, reason in stale:
+                if reason:
+                    self._evict(entry_id, reason)
+            self._last_purge = time.time()
+
+    def add(self, enriched_question, sql, result_tuple, embedding=None):
         """
         Add a new query to cache.
-        result_tuple = (json_result, ascii_result)
+        result_tuple = (json_result, ascii_result), or (json_result,
+                       ascii_result, more) where `more` records whether rows
+                       beyond these existed; hits return it as it was added
+        embedding    = optional precomputed embedding; if omitted, the
+                       embedder's memo returns the one computed by search(),
+                       so a miss followed by add encodes once.
         """
         print(f"[CACHE ADD] Storing query: {enriched_question[:60]}...")
-        self.queries.append(enriched_question)
-        self.entries.append({
+        if embedding is None:
+            embedding = self._encode(enriched_question)
+        emb = np.asarray(embedding, dtype="float32").reshape(1, -1)
+
+        entry = {
             "enriched": enriched_question,
             "sql": sql,
             "json_result": result_tuple[0],   # structured JSON
-            "ascii_result": result_tuple[1]   # pretty table string
-        })
-        self._rebuild_index()
+            "ascii_result": result_tuple[1],  # pretty table string
+            "created": time.time(),
+            "tables": [],
+            "versions": {},
+            "more": result_tuple[2] if len(result_tuple) > 2 else None,
+        }
+        if self.tracker:
+            entry["tables"] = self.tracker.referenced_tables(sql)
+            versions = self.tracker.versions()
+            entry["versions"] = {t: versions.get(t) for t in entry["tables"]}
+
+        with self.lock:
+            if self.store:
+                entry_id = self.store.append(entry, emb)
+            else:
+                entry_id = self._next_id
+            entry["id"] = entry_id
+            self._insert(entry_id, entry, emb[0])
 
-    def search(self, enriched_question, threshold=0.80):
+            # Append only the new vector instead of re-encoding everything
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(emb.shape[1]))
+            self.index.add_with_ids(emb, np.array([entry_id], dtype="int64"))
+
+            self._enforce_limits()
+            if self.ttl is not None and time.time() - self._last_purge > self.ttl:
+                self.purge()
+
+    def flush(self):
+        """Wait for pending disk writes (no-op for an in-memory cache)."""
+        if self.store:
+            self.store.flush()
+
+    def _hit(self, match, tier, detail=""):
+        print(f"[CACHE HIT] {tier}{detail}")
+        metrics.inc("nl2sql_cache_lookups_total", tier=tier, result="hit")
+        self.entries.move_to_end(match["id"])
+        result = (match["json_result"], match["ascii_result"])
+        return match["sql"], result if match.get("more") is None else result + (match["more"],)
+
+    def search(self, enriched_question, threshold=0.80, semantic=True):
         """
-        Search for a similar query in cache.
-        Returns (sql, (json_result, ascii_result)) if found.
+        Search for the same or a similar query in cache.
+        Returns (sql, result_tuple) as passed to add() if found.
+        semantic=False only accepts exact repeats (e.g. follow-ups, whose
+        enriched text is mostly shared context that embeds alike).
         """
-        if not self.index:
+        hit = self.search_exact(enriched_question)
+        if hit or not semantic:
+            return hit
+        return self.search_semantic(enriched_question, threshold)
+
+    def search_exact(self, enriched_question):
+        """Tier 1: exact (normalized) repeat, answered without the embedder."""
+        with self.lock:
+            key = question_key(enriched_question)
+            entry_id = self.exact.get(key) if key else None
+            if entry_id is not None:
+                match = self.entries[entry_id]
+                stale = self._is_stale(match)
+                if not stale:
+                    return self._hit(match, "exact")
+                self._evict(entry_id, stale)
+        metrics.inc("nl2sql_cache_lookups_total", tier="exact", result="miss")
+        return None
+
+    def search_semantic(self, enriched_question, threshold=0.80):
+        """Tier 2: semantic (FAISS) match on a paraphrase; call after an exact-tier miss."""
+        if self.index is None or not self.entries:
             print("[CACHE MISS] Cache empty")
+            metrics.inc("nl2sql_cache_lookups_total", tier="semantic", result="miss")
             return None
 
         print(f"[CACHE SEARCH] Looking for: {enriched_question[:60]}...")
-        q_emb = self.model.encode([enriched_question]).astype("float32")
-        D, I = self.index.search(q_emb, 1)
-        score = 1 / (1 + D[0][0])
+        q_emb = self._encode(enriched_question)
+        with self.lock:
+            if self.index is None or not self.entries:
+                metrics.inc("nl2sql_cache_lookups_total", tier="semantic", result="miss")
+                return None
+            # Ask for one more neighbour than there are tombstones: the best live one is among them
+            dead = self.index.ntotal - len(self.entries)
+            D, I = self.index.search(q_emb, min(dead + 1, self.index.ntotal))
+            best = next(k for k, i in enumerate(I[0]) if int(i) in self.entries)
+            score = 1 / (1 + D[0][best])
 
-        if score >= threshold:
-            print(f"[CACHE HIT] score={score:.2f}")
-            match = self.entries[I[0][0]]
-            return match["sql"], (match["json_result"], match["ascii_result"])
+            if score >= threshold:
+                match = self.entries[int(I[0][best])]
+                stale = self._is_stale(match)
+                if stale:
+                    self._evict(match["id"], stale)
+                    print(f"[CACHE MISS] score={score:.2f} ({stale})")
+                    metrics.inc("nl2sql_cache_lookups_total", tier="semantic", result="miss")
+                    return None
+                return self._hit(match, "semantic", f" score={score:.2f}")
 
         print(f"[CACHE MISS] score={score:.2f}")
+        metrics.inc("nl2sql_cache_lookups_total", tier="semantic", result="miss")
         return None
+
+
+# Results that change without any table changing: clock, randomness, connection state, catalog
+VOLATILE_SQL = re.compile(r"""
+    '\s*now\s*'
+  | \b(?:current_date|current_time|current_timestamp)\b
+  | \b(?:date|time|datetime|julianday|unixepoch|strftime)\s*\(\s*\)
+  | \b(?:random|randomblob|changes|total_changes|last_insert_rowid)\s*\(
+  | \b(?:sqlite_\w+|pragma_\w+)\b
+""", re.I | re.X)
+
+
+def is_volatile(sql):
+    """True when the result of `sql` can change while its tables do not (e.g. date('now'), random())."""
+    return bool(VOLATILE_SQL.search(sql or ""))
+
+
+class ResultCache:
+    """
+    Result pages of executed SQL, keyed by canonical SQL (canonical_sql)
+    plus the page bounds, so differently worded questions that produce the
+    same query run it once per data version. Each page remembers the
+    versions of the tables its SQL references (db.ChangeTracker, views
+    resolved to base tables) and is dropped once any of them changes or it
+    is older than `ttl` seconds. Bounded by entries and approximate bytes
+    (LRU); failed queries are never cached, and SQL that reads no known
+    table or is volatile (is_volatile) bypasses the cache.
+    """
+
+    def __init__(self, tracker, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=300):
+        self.tracker = tracker
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> {"page", "versions", "size"}, in LRU order
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, tracker):
+        """
+        RESULT_CACHE_MAX_ENTRIES (default 1000, 0 disables the cache),
+        RESULT_CACHE_MAX_BYTES (64 MiB) and RESULT_CACHE_TTL_SECONDS (300);
+        an empty value disables that limit.
+        """
+        def env(name, default, cast=int):
+            value = os.getenv(name, default)
+            return cast(value) if value else None
+
+        return cls(tracker,
+                   max_entries=env("RESULT_CACHE_MAX_ENTRIES", "1000"),
+                   max_bytes=env("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)),
+                   ttl=env("RESULT_CACHE_TTL_SECONDS", "300", float))
+
+    @staticmethod
+    def key(sql, limit, offset):
+        text = f"{canonical_sql(sql)}\x1f{limit}\x1f{offset}"
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def snapshot(self, sql):
+        """
+        Versions of the tables `sql` reads, taken before it runs (so a
+        concurrent write invalidates), or None when it must not be cached.
+        """
+        tables = self.tracker.referenced_tables(sql)
+        if not tables or is_volatile(sql):
+            return None
+        versions = self.tracker.versions()
+        return {t: versions.get(t) for t in tables}
+
+    def get(self, sql, limit, offset=0):
+        """Cached (json_result, ascii_result, next_token) page, or None."""
+        key = self.key(sql, limit, offset)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                current = self.tracker.versions()
+                fresh = self.ttl is None or time.time() - entry["created"] <= self.ttl
+                if fresh and all(current.get(t) == v for t, v in entry["versions"].items()):
+                    self.entries.move_to_end(key)
+                    print(f"[RESULT CACHE HIT] {canonical_sql(sql)[:60]}...")
+                    metrics.inc("nl2sql_result_cache_lookups_total", result="hit")
+                    return entry["page"]
+                self._drop(key)
+        metrics.inc("nl2sql_result_cache_lookups_total", result="miss")
+        return None
+
+    def put(self, sql, limit, offset, page, versions):
+        """Store a page; `versions` is the snapshot() taken before the query ran (None: not cached)."""
+        if versions is None:
+            return
+        json_result, ascii_result, _ = page
+        size = len(ascii_result or "") + len(json.dumps(json_result, default=str))
+        key = self.key(sql, limit, offset)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = {"page": page, "versions": versions, "size": size, "created": time.time()}
+            self.nbytes += size
+            while self.entries and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        self.nbytes -= self.entries.pop(key)["size"]
+
+    def __len__(self):
+        return len(self.entries)
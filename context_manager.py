@@ -1,14 +1,76 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+def estimate_tokens(text):
+    """Rough LLM token count (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def summarize_result(result, max_rows=3, max_chars=300):
+    """
+    Compact form of a query result for follow-up prompts: row count, column
+    names and the first `max_rows` rows. `result` is (json_result,
+    ascii_result) or just the text (psql table, error or notice).
+    """
+    if isinstance(result, tuple):
+        rows, text = result
+        if rows:
+            columns = list(rows[0])
+            shown = "; ".join(", ".join(f"{k}={v}" for k, v in row.items()) for row in rows[:max_rows])
+            more = f" (+{len(rows) - max_rows} more)" if len(rows) > max_rows else ""
+            summary = f"{len(rows)} row(s); columns: {', '.join(columns)}; first rows: {shown}"
+            return (summary if len(summary) <= max_chars else summary[:max_chars] + "...") + more
+        result = text
+
+    lines = str(result).splitlines()
+    # psql table: border, header, border, rows..., border
+    if len(lines) >= 4 and lines[0].startswith("+-") and lines[2].startswith("+-"):
+        data = [l for l in lines[3:] if not l.startswith("+-")]
+        kept = lines[:3] + data[:max_rows]
+        if len(data) > max_rows:
+            kept.append(f"... ({len(data)} rows total)")
+        return "\n".join(kept)
+    text = str(result)
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
 class ContextManager:
-    def __init__(self):
-        self.history = []  
+    def __init__(self, max_turns=None, max_tokens=None):
+        # Ring buffer: only the last `max_turns` turns are kept (None = unbounded)
+        self.history = deque(maxlen=max_turns)
+        # Token budget for the context part of the prompt (None = paste full results)
+        self.max_tokens = max_tokens
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+
+    @staticmethod
+    def _size(entry):
+        return sum(len(str(v)) for v in entry.values())
 
     def add_entry(self, question, sql, result):
-        """Save a new query interaction to history."""
-        self.history.append({
+        """
+        Save a new query interaction to history. `result` is the result text
+        or (json_result, ascii_result); with a token budget only its summary
+        is kept.
+        """
+        if self.max_tokens:
+            result = summarize_result(result)
+        elif isinstance(result, tuple):
+            result = result[1]
+        entry = {
             "question": question,
             "sql": sql,
             "result": result
-        })
+        }
+        if self.history.maxlen and len(self.history) == self.history.maxlen:
+            self.nbytes -= self._size(self.history[0])
+        self.history.append(entry)
+        self.nbytes += self._size(entry)
+        self.last_used = time.monotonic()
 
     def get_last(self):
         """Get the most recent query context."""
@@ -16,20 +78,43 @@ class ContextManager:
             return None
         return self.history[-1]
 
+    def _fit_budget(self, turns):
+        """
+        Turn texts (oldest first) within max_tokens: newest turns are kept
+        first, SQL always verbatim; when even the newest turn is too big its
+        result is dropped.
+        """
+        texts, used = [], 0
+        for h in reversed(turns):
+            text = f"Q: {h['question']}\nSQL: {h['sql']}\nResult: {h['result']}\n"
+            cost = estimate_tokens(text)
+            if used + cost > self.max_tokens:
+                if texts:
+                    break
+                text = f"Q: {h['question']}\nSQL: {h['sql']}\n"
+                cost = estimate_tokens(text)
+            texts.append(text)
+            used += cost
+        return list(reversed(texts))
+
     def build_context_prompt(self, current_question, window=3):
         """
-        Build prompt using the last N turns (default 3).
+        Build prompt using the last N turns (default 3), within max_tokens.
         """
+        self.last_used = time.monotonic()
         if not self.history:
             return current_question
 
         # take last `window` turns
-        recent_history = self.history[-window:]
+        recent_history = list(self.history)[-window:]
 
-        context_text = "\n".join(
-        f"Q: {h['question']}\nSQL: {h['sql']}\nResult: {h['result']}\n"
-        for h in recent_history
-    )
+        if self.max_tokens:
+            context_text = "\n".join(self._fit_budget(recent_history))
+        else:
+            context_text = "\n".join(
+            f"Q: {h['question']}\nSQL: {h['sql']}\nResult: {h['result']}\n"
+            for h in recent_history
+        )
 
         enriched = f"""
     Previous conversation:
@@ -39,3 +124,89 @@ class ContextManager:
     """
         return enriched
 
+
+class SessionStore:
+    """
+    One ContextManager per session id, so follow-ups are only enriched with
+    the same client's history.
+
+    Sessions live in an OrderedDict in least-recently-used order: lookup is
+    O(1), idle sessions (unused for `idle_seconds`) are dropped from the
+    front as requests come in, and the least recently used sessions are
+    evicted whenever `max_sessions` or `max_bytes` (history text held
+    across all sessions) is exceeded. Each session keeps at most `max_turns`.
+    """
+
+    def __init__(self, max_turns=10, idle_seconds=None, max_sessions=None, max_bytes=None, max_tokens=None):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        CONTEXT_MAX_TURNS (default 10), CONTEXT_IDLE_SECONDS (1800),
+        CONTEXT_MAX_SESSIONS (10000), CONTEXT_MAX_BYTES (64 MiB),
+        CONTEXT_MAX_TOKENS (1000); an empty value disables that limit.
+        """
+        def limit(name, default, kind=int):
+            value = os.getenv(name, default)
+            return kind(value) if value else None
+
+        return cls(
+            max_turns=limit("CONTEXT_MAX_TURNS", "10"),
+            idle_seconds=limit("CONTEXT_IDLE_SECONDS", "1800", float),
+            max_sessions=limit("CONTEXT_MAX_SESSIONS", "10000"),
+            max_bytes=limit("CONTEXT_MAX_BYTES", str(64 * 1024 * 1024)),
+            max_tokens=limit("CONTEXT_MAX_TOKENS", "1000"),
+        )
+
+    def _drop(self, session_id):
+        self.nbytes -= self.sessions.pop(session_id).nbytes
+
+    def _evict(self):
+        """Drop idle sessions, then LRU sessions while over a limit (caller holds the lock)."""
+        if self.idle_seconds:
+            cutoff = time.monotonic() - self.idle_seconds
+            while self.sessions and next(iter(self.sessions.values())).last_used < cutoff:
+                self._drop(next(iter(self.sessions)))
+        while self.sessions and (
+            (self.max_sessions and len(self.sessions) > self.max_sessions)
+            or (self.max_bytes and self.nbytes > self.max_bytes)
+        ):
+            self._drop(next(iter(self.sessions)))
+
+    def get(self, session_id=None):
+        """
+        (session_id, ContextManager) for `session_id`; a new session (with a
+        generated id when none was given) if it is unknown or was evicted.
+        """
+        with self.lock:
+            session_id = session_id or uuid.uuid4().hex
+            context = self.sessions.get(session_id)
+            if context is None:
+                context = self.sessions[session_id] = ContextManager(self.max_turns, self.max_tokens)
+            self.sessions.move_to_end(session_id)
+            context.last_used = time.monotonic()
+            self._evict()
+            return session_id, context
+
+    def add_entry(self, session_id, question, sql, result):
+        """Record a turn for `session_id` (recreated if it was evicted meanwhile)."""
+        with self.lock:
+            context = self.sessions.get(session_id)
+            if context is None:
+                context = self.sessions[session_id] = ContextManager(self.max_turns, self.max_tokens)
+            before = context.nbytes
+            context.add_entry(question, sql, result)
+            self.nbytes += context.nbytes - before
+            self.sessions.move_to_end(session_id)
+            self._evict()
+
+    def __len__(self):
+        return len(self.sessions)
@@ -1,28 +1,339 @@
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import subprocess, sys
 
+# Per-table change counters, maintained by triggers (see install_change_tracking)
+TRACKING_TABLE = "nl2sql_table_versions"
+
 def get_connection(db_name="demo1.db"):
     """Return SQLite connection, auto-seed if db missing."""
     if not Path(db_name).exists():
         subprocess.run([sys.executable, "seed_db.py"], check=True)
     return sqlite3.connect(db_name,check_same_thread=False)
 
+class ConnectionPool:
+    """
+    Pool of read-only SQLite connections, checked out per request so
+    concurrent questions run in parallel instead of sharing one cursor.
+
+    The database is switched to WAL once (readers never block each other or
+    a writer), and every pooled connection is opened with mode=ro plus
+    PRAGMA query_only, so LLM-generated SQL cannot modify data.
+    """
+
+    def __init__(self, db_name="demo1.db", size=None, cache_size_kib=None, mmap_size=None, timeout=None):
+        if not Path(db_name).exists():
+            subprocess.run([sys.executable, "seed_db.py"], check=True)
+        self.db_name = db_name
+        self.size = size or int(os.getenv("DB_POOL_SIZE", "8"))
+        # Longest wait for a free connection (streams hold one while the client reads)
+        self.timeout = timeout if timeout is not None else float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+        self.cache_size_kib = cache_size_kib or int(os.getenv("DB_CACHE_SIZE_KIB", "65536"))
+        self.mmap_size = mmap_size if mmap_size is not None else int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+        # Kept open so the -wal/-shm files exist for the read-only connections
+        self._writer = sqlite3.connect(db_name, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL;")
+
+        self._pool = queue.LifoQueue()
+        for _ in range(self.size):
+            self._pool.put(self._open())
+
+    def _open(self):
+        conn = sqlite3.connect(f"file:{Path(self.db_name).resolve().as_posix()}?mode=ro",
+                               uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only=ON;")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_size_kib};")   # negative = KiB
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size};")
+        return conn
+
+    def acquire(self, timeout=None):
+        """
+        Check out a connection, waiting at most `timeout` seconds (default
+        self.timeout, 0 = forever) while all are in use; raises TimeoutError.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return self._pool.get(timeout=timeout or None)
+        except queue.Empty:
+            raise TimeoutError(f"no database connection free after {timeout:g}s") from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._pool.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self._writer.close()
+
+def list_tables(cursor):
+    """Names of user tables (internal bookkeeping tables excluded)."""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    return [r[0] for r in cursor.fetchall() if r[0] != TRACKING_TABLE]
+
+def read_table(cursor, table_name):
+    """{"columns": [(name, type), ...], "foreign_keys": [(column, ref_table, ref_column), ...]}"""
+    cursor.execute(f"PRAGMA table_info({table_name});")
+    columns = [(c[1], c[2]) for c in cursor.fetchall()]
+    cursor.execute(f"PRAGMA foreign_key_list({table_name});")
+    foreign_keys = [(fk[3], fk[2], fk[4]) for fk in cursor.fetchall()]
+    return {"columns": columns, "foreign_keys": foreign_keys}
+
+def extract_tables(db_name="demo1.db"):
+    """Structured schema: {table: read_table(...)} for all tables in db."""
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    tables = {name: read_table(cursor, name) for name in list_tables(cursor)}
+    conn.close()
+    return tables
+
+def format_table(table_name, info, columns=None):
+    """Schema line for a table ("Table t: a (TYPE), b (TYPE)"), optionally only some columns."""
+    cols = [c for c in info["columns"] if columns is None or c[0] in columns]
+    return f"Table {table_name}: " + ", ".join([f"{name} ({kind})" for name, kind in cols])
+
+def tables_from_schema(schema_info):
+    """Structured tables (no foreign keys) from extract_schema() lines."""
+    tables = {}
+    for line in schema_info:
+        if not line.startswith("Table ") or ":" not in line:
+            continue
+        name, cols = line[len("Table "):].split(":", 1)
+        columns = []
+        for col in cols.split(","):
+            col = col.strip()
+            if col:
+                col_name, _, kind = col.partition(" (")
+                columns.append((col_name.strip(), kind.rstrip(")")))
+        tables[name.strip()] = {"columns": columns, "foreign_keys": []}
+    return tables
+
 def extract_schema(db_name="demo1.db"):
     """Extract schema info for all tables in db."""
+    return [format_table(name, info) for name, info in extract_tables(db_name).items()]
+
+class SchemaCatalog:
+    """
+    Schema of a database, kept in sync cheaply.
+
+    `PRAGMA schema_version` is bumped by SQLite on every DDL change, so
+    refresh() costs one pragma while nothing changed. When it moves, each
+    table's CREATE statement in sqlite_master is compared with the last
+    one seen and only added/changed tables are re-read with PRAGMA
+    table_info. The result is persisted to `cache_dir` (SCHEMA_CACHE_DIR,
+    default "schema_cache"; empty disables), so a restart against an
+    unchanged database reads no table metadata at all.
+    """
+
+    def __init__(self, db_name="demo1.db", cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.getenv("SCHEMA_CACHE_DIR", "schema_cache")
+        self.db_name = db_name
+        self.path = Path(cache_dir) / "catalog.json" if cache_dir else None
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.version = None
+        self.tables = {}
+        self.fingerprints = {}   # table -> CREATE statement
+        self._load()
+        self.refresh()
+
+    def _load(self):
+        if not (self.path and self.path.exists()):
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("db") != str(Path(self.db_name).resolve()):
+            return
+        self.version = data["version"]
+        self.fingerprints = data["fingerprints"]
+        self.tables = {name: {"columns": [tuple(c) for c in info["columns"]],
+                              "foreign_keys": [tuple(fk) for fk in info["foreign_keys"]]}
+                       for name, info in data["tables"].items()}
+
+    def _save(self):
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"db": str(Path(self.db_name).resolve()), "version": self.version,
+                                   "fingerprints": self.fingerprints, "tables": self.tables}),
+                       encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    @property
+    def schema_info(self):
+        """extract_schema()-style lines."""
+        return [format_table(name, info) for name, info in self.tables.items()]
+
+    def refresh(self):
+        """
+        Pick up schema changes. Returns (changed, removed) table-name sets,
+        or None when the schema is unchanged.
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+            version = cursor.execute("PRAGMA schema_version;").fetchone()[0]
+            if version == self.version:
+                return None
+
+            rows = cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table';").fetchall()
+            current = {name: sql for name, sql in rows if name != TRACKING_TABLE}
+            changed = {name for name, sql in current.items() if self.fingerprints.get(name) != sql}
+            removed = set(self.tables) - set(current)
+            for name in changed:
+                self.tables[name] = read_table(cursor, name)
+            for name in removed:
+                self.tables.pop(name, None)
+            self.tables = {name: self.tables[name] for name in current}   # keep sqlite_master order
+            self.fingerprints = current
+            self.version = version
+            self._save()
+            if not (changed or removed):
+                return None
+            print(f"[SCHEMA] version {version}: {len(changed)} table(s) (re)read, {len(removed)} removed")
+            return changed, removed
+
+# ----------------------------
+# Data-change tracking
+# ----------------------------
+def install_change_tracking(db_name="demo1.db"):
+    """
+    Add per-table change counters: a bookkeeping table plus AFTER
+    INSERT/UPDATE/DELETE triggers that bump the counter of the table written.
+    Idempotent; run it from a process allowed to change the schema.
+    """
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {TRACKING_TABLE} "
+        "(table_name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0);"
+    )
+    for table in list_tables(cursor):
+        if table.startswith("sqlite_"):
+            continue
+        cursor.execute(f"INSERT OR IGNORE INTO {TRACKING_TABLE} (table_name, version) VALUES (?, 0);", (table,))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS "nl2sql_{table}_{op.lower()}" AFTER {op} ON "{table}" '
+                f"BEGIN UPDATE {TRACKING_TABLE} SET version = version + 1 WHERE table_name = '{table}'; END;"
+            )
+    conn.commit()
+    conn.close()
 
-    schema_info = []
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
+class ChangeTracker:
+    """
+    Reports a version per table so cached results can be invalidated when
+    their tables change.
 
-    for table in tables:
-        table_name = table[0]
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        col_str = ", ".join([f"{c[1]} ({c[2]})" for c in columns])
-        schema_info.append(f"Table {table_name}: {col_str}")
+    `PRAGMA data_version` is checked on every call (no I/O unless another
+    connection committed). When it moves, per-table counters are re-read if
+    install_change_tracking() was run. Otherwise every table gets a
+    fingerprint of the database files (size + mtime of the db and its WAL),
+    i.e. any write invalidates everything. Versions stay meaningful across
+    restarts, so a persisted cache does not serve rows changed while the
+    service was down.
+    """
 
-    conn.close()
-    return schema_info
+    def __init__(self, db_name="demo1.db"):
+        self.db_name = db_name
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.reload()
+        self._data_version = None
+        self._fingerprint = None
+        self._bumps = 0
+        self._versions = {}
+
+    def reload(self):
+        """Re-read table and view names (after a schema change)."""
+        with self.lock:
+            cursor = self.conn.cursor()
+            self.tables = [t.lower() for t in list_tables(cursor)]
+            self.tracked = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (TRACKING_TABLE,)
+            ).fetchone() is not None
+            view_sql = {name.lower(): sql for name, sql in
+                        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='view';").fetchall()}
+            self.views = {view: resolve_views(view_sql[view], self.tables, view_sql) for view in view_sql}
+
+    def fingerprint(self):
+        """Version for untracked data: size + mtime of the database file and its WAL."""
+        parts = []
+        for path in (Path(self.db_name), Path(f"{self.db_name}-wal")):
+            try:
+                st = path.stat()
+            except OSError:
+                st = None
+            # An empty or missing WAL holds no data (it comes and goes with connections)
+            parts.append(f"{st.st_size}:{st.st_mtime_ns}" if st and st.st_size else "-")
+        fingerprint = "/".join(parts)
+        # A commit that leaves size and (coarse) mtime unchanged still gets a new version
+        if fingerprint == self._fingerprint:
+            self._bumps += 1
+        else:
+            self._fingerprint, self._bumps = fingerprint, 0
+        return fingerprint + (f"+{self._bumps}" if self._bumps else "")
+
+    def versions(self):
+        """Current {table: version} snapshot."""
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+            if data_version != self._data_version or len(self._versions) != len(self.tables):
+                self._data_version = data_version
+                fingerprint = self.fingerprint()
+                counters = {}
+                if self.tracked:
+                    rows = self.conn.execute(f"SELECT table_name, version FROM {TRACKING_TABLE};").fetchall()
+                    counters = {name.lower(): version for name, version in rows}
+                # Tables without a counter (untracked db, or created after tracking was installed)
+                self._versions = {t: counters.get(t, fingerprint) for t in self.tables}
+            return self._versions
+
+    def referenced_tables(self, sql):
+        """Tables `sql` reads, with views resolved to their base tables."""
+        if not sql:
+            return []
+        words = {w.lower() for w in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", sql)}
+        tables = set(referenced_tables(sql, self.tables))
+        for view in words & set(self.views):
+            tables.update(self.views[view])
+        return sorted(tables)
+
+def referenced_tables(sql, tables):
+    """
+    Names from `tables` mentioned in a SQL string. Over-approximates (any
+    matching word counts) but sees only the names given: views and tables
+    created later are not resolved (see ChangeTracker.referenced_tables).
+    """
+    if not sql:
+        return []
+    words = {w.lower() for w in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", sql)}
+    return sorted(t for t in tables if t.lower() in words)
+
+def resolve_views(sql, tables, view_sql, seen=()):
+    """Base tables read by `sql`, following views ({view: CREATE VIEW sql}) recursively."""
+    words = {w.lower() for w in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", sql or "")}
+    found = set(referenced_tables(sql, tables))
+    for view in words & set(view_sql):
+        if view not in seen:
+            found.update(resolve_views(view_sql[view], tables, view_sql, seen + (view,)))
+    return sorted(found)
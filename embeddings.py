@@ -0,0 +1,155 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent encode calls into one batched forward pass.
+
+    Callers block on encode(); a worker thread takes the first pending
+    request, gathers more for up to max_wait_ms (or until max_batch_size
+    texts), encodes them together and hands each caller its rows. The wait
+    only applies once concurrent traffic has been seen (the previous batch
+    held several requests), so a lone client pays no extra latency; while a
+    batch is running new requests queue up and are picked up immediately.
+    """
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait_ms=2):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._loop, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, texts):
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result()
+
+    def _loop(self):
+        concurrent = False
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + (self.max_wait if concurrent else 0)
+            while size < self.max_batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                batch.append(item)
+                size += len(item[0])
+
+            concurrent = len(batch) > 1
+            texts = [t for item_texts, _ in batch for t in item_texts]
+            try:
+                vectors = self.encode_fn(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for item_texts, future in batch:
+                future.set_result(vectors[start:start + len(item_texts)])
+                start += len(item_texts)
+
+
+class Embedder:
+    """
+    Sentence embedding service shared by QueryCache and SchemaRetriever.
+
+    The SentenceTransformer is loaded on first use, and recent text→vector
+    encodings are memoised so a question embedded for the cache lookup is
+    not embedded again for schema retrieval. With max_batch_size > 1,
+    concurrent requests are micro-batched (see EmbeddingBatcher).
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL, memo_size=1024, max_batch_size=1, max_wait_ms=2):
+        self.model_name = model_name
+        self.memo_size = memo_size
+        self._model = None
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self.batcher = None
+        if max_batch_size > 1:
+            self.batcher = EmbeddingBatcher(self._encode_batch, max_batch_size, max_wait_ms)
+
+    @property
+    def model(self):
+        """The SentenceTransformer, loaded lazily."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    print(f"[EMBEDDER] Loading {self.model_name}...")
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def _encode_batch(self, texts):
+        return self.model.encode(texts, batch_size=max(len(texts), 1)).astype("float32")
+
+    def encode(self, texts, memo=True):
+        """
+        Return an (n, dim) float32 array for `texts`.
+        memo=False skips the memo (e.g. one-off bulk encodes like the schema).
+        """
+        texts = list(texts)
+        if not memo:
+            return self.model.encode(texts).astype("float32")
+
+        found = {}
+        with self._lock:
+            for t in texts:
+                if t in self._memo:
+                    self._memo.move_to_end(t)
+                    found[t] = self._memo[t]
+        missing = list(dict.fromkeys(t for t in texts if t not in found))
+
+        if missing:
+            if self.batcher:
+                vectors = self.batcher.encode(missing)
+            else:
+                vectors = self._encode_batch(missing)
+            with self._lock:
+                for t, v in zip(missing, vectors):
+                    found[t] = v
+                    self._memo[t] = v
+                while len(self._memo) > self.memo_size:
+                    self._memo.popitem(last=False)
+
+        return np.stack([found[t] for t in texts])
+
+
+_embedders = {}
+_registry_lock = threading.Lock()
+
+def get_embedder(model_name=DEFAULT_MODEL):
+    """
+    Process-wide Embedder for `model_name` (one model load per process).
+    Micro-batching is configured by EMBED_MAX_BATCH (default 32; 1 disables)
+    and EMBED_MAX_WAIT_MS (default 2).
+    """
+    with _registry_lock:
+        if model_name not in _embedders:
+            _embedders[model_name] = Embedder(
+                model_name,
+                max_batch_size=int(os.getenv("EMBED_MAX_BATCH", "32")),
+                max_wait_ms=float(os.getenv("EMBED_MAX_WAIT_MS", "2")),
+            )
+        return _embedders[model_name]
@@ -1,10 +1,8 @@
-import google.generativeai as genai
+from llm_client import get_client
 
-def explain_result(question, sql, result_text, model_name="gemini-2.0-flash"):
-    """
-    Generate a human-friendly explanation of SQL result.
-    """
-    prompt = f"""
+def build_explain_prompt(question, sql, result_text):
+    """Prompt asking Gemini to explain a result table in plain English."""
+    return f"""
     The user asked: {question}
     The SQL executed: {sql}
     The result table was:
@@ -13,6 +11,14 @@ def explain_result(question, sql, result_text, model_name="gemini-2.0-flash"):
     Please explain the result in 1–2 clear sentences.
     """
 
-    model = genai.GenerativeModel(model_name)
-    response = model.generate_content(prompt)
-    return response.text.strip()
+def explain_result(question, sql, result_text, model_name="gemini-2.0-flash"):
+    """
+    Generate a human-friendly explanation of SQL result.
+    """
+    prompt = build_explain_prompt(question, sql, result_text)
+    return get_client().generate(prompt, model_name).strip()
+
+async def explain_result_async(question, sql, result_text, model_name="gemini-2.0-flash"):
+    """Async explain_result using Gemini's async client."""
+    prompt = build_explain_prompt(question, sql, result_text)
+    return (await get_client().generate_async(prompt, model_name)).strip()
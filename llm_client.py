@@ -0,0 +1,307 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+import google.generativeai as genai
+
+import metrics
+from context_manager import estimate_tokens
+
+# HTTP statuses worth retrying: quota (429) and transient server errors
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Request rate limiter: `rate` tokens per second, up to `capacity` banked
+    for bursts. Callers reserve a token and sleep off any deficit, so
+    concurrent callers are spaced out in arrival order instead of all
+    retrying at once.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token; returns the seconds to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def is_retryable(error):
+    """429/5xx from the Gemini client (google.api_core exceptions carry the HTTP status as `.code`)."""
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS
+
+
+# ----------------------------
+# Backends
+# ----------------------------
+class GeminiBackend:
+    """Google Gemini; GenerativeModel objects are created once per model name and reused."""
+
+    online = True   # real quota: rate-limited, needs GOOGLE_API_KEY
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def model(self, model_name):
+        with self._lock:
+            if model_name not in self._models:
+                self._models[model_name] = genai.GenerativeModel(model_name)
+            return self._models[model_name]
+
+    def generate(self, prompt, model_name):
+        return self.model(model_name).generate_content(prompt).text
+
+    async def generate_async(self, prompt, model_name):
+        return (await self.model(model_name).generate_content_async(prompt)).text
+
+
+class StubBackend:
+    """
+    Deterministic offline stand-in for load tests and benchmarks.
+
+    Every call waits `latency_ms` (simulated model time) and answers from
+    the prompt alone: SQL prompts get the first canned SQL whose key occurs
+    in the question (`canned`: {substring: sql}, e.g. loaded from a JSON
+    file), else `SELECT * FROM <first table in the schema> LIMIT 10;`;
+    explanation prompts get a fixed sentence.
+    """
+
+    online = False
+
+    def __init__(self, latency_ms=0, canned=None):
+        self.latency = latency_ms / 1000
+        self.canned = canned or {}
+
+    def respond(self, prompt):
+        if "translates natural language to SQL" in prompt or "fixes invalid SQL" in prompt:
+            # The (follow-up) question is after the last "question:" marker
+            question = re.split(r"question:", prompt, flags=re.IGNORECASE)[-1].lower()
+            for key, sql in self.canned.items():
+                if key.lower() in question:
+                    return sql
+            table = re.search(r"Table (\w+):", prompt)
+            return f"SELECT * FROM {table.group(1)} LIMIT 10;" if table else "SELECT 1;"
+        return "This is a stub explanation of the result."
+
+    def generate(self, prompt, model_name):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(prompt)
+
+    async def generate_async(self, prompt, model_name):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(prompt)
+
+
+class RecordReplayBackend:
+    """
+    Stores prompt→response pairs on disk (JSONL, keyed by a hash of model +
+    prompt). In "record" mode misses go to `inner` (Gemini) and are saved;
+    in "replay" mode everything must come from the recording, so runs are
+    offline and reproducible.
+    """
+
+    def __init__(self, directory="llm_recordings", mode="replay", inner=None):
+        self.path = Path(directory) / "responses.jsonl"
+        self.mode = mode
+        self.inner = inner or (GeminiBackend() if mode == "record" else None)
+        self.online = mode == "record"
+        self.responses = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as fh:
+                for line in fh:
+                    if line.strip():
+                        item = json.loads(line)
+                        self.responses[item["key"]] = item["response"]
+
+    @staticmethod
+    def key(prompt, model_name):
+        return hashlib.sha256(f"{model_name}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        if key in self.responses:
+            return self.responses[key]
+        if self.mode != "record":
+            raise LookupError(f"No recorded LLM response for prompt {key[:12]} in {self.path}")
+        return None
+
+    def _save(self, key, prompt, model_name, response):
+        with self._lock:
+            self.responses[key] = response
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as fh:
+                fh.write(json.dumps({"key": key, "model": model_name, "prompt": prompt,
+                                     "response": response}) + "\n")
+
+    def generate(self, prompt, model_name):
+        key = self.key(prompt, model_name)
+        response = self._lookup(key)
+        if response is None:
+            response = self.inner.generate(prompt, model_name)
+            self._save(key, prompt, model_name, response)
+        return response
+
+    async def generate_async(self, prompt, model_name):
+        key = self.key(prompt, model_name)
+        response = self._lookup(key)
+        if response is None:
+            response = await self.inner.generate_async(prompt, model_name)
+            self._save(key, prompt, model_name, response)
+        return response
+
+
+def backend_from_env():
+    """
+    LLM_BACKEND: "gemini" (default), "stub" (LLM_STUB_LATENCY_MS,
+    LLM_STUB_SQL = JSON file of {question substring: sql}), "record" or
+    "replay" (LLM_RECORD_DIR, default "llm_recordings").
+    """
+    name = os.getenv("LLM_BACKEND", "gemini").lower()
+    if name == "stub":
+        canned = {}
+        if os.getenv("LLM_STUB_SQL"):
+            canned = json.loads(Path(os.getenv("LLM_STUB_SQL")).read_text(encoding="utf-8"))
+        return StubBackend(float(os.getenv("LLM_STUB_LATENCY_MS", "0")), canned)
+    if name in ("record", "replay"):
+        return RecordReplayBackend(os.getenv("LLM_RECORD_DIR", "llm_recordings"), mode=name)
+    if name != "gemini":
+        raise ValueError(f"❌ Unknown LLM_BACKEND {name!r} (gemini, stub, record, replay)")
+    return GeminiBackend()
+
+
+# ----------------------------
+# Client
+# ----------------------------
+class LLMClient:
+    """
+    Shared entry point for every LLM call (SQL generation, repair,
+    explanation), on top of a pluggable backend (see backend_from_env).
+
+    - A token bucket keeps the request rate within quota (smooths bursts).
+    - At most `max_concurrency` calls are in flight (threads and asyncio
+      tasks counted separately).
+    - 429/5xx responses are retried with jittered exponential backoff
+      ("full jitter": a random delay up to base * 2**attempt, capped).
+
+    Rate limiting only applies to online backends; the stub and replay
+    backends run at full speed.
+    """
+
+    def __init__(self, backend=None, rate_per_min=None, burst=None, max_concurrency=None,
+                 max_retries=None, backoff_base=None, backoff_max=None):
+        def env(name, default, kind=float):
+            return kind(os.getenv(name, default))
+
+        self.backend = backend or backend_from_env()
+        rate_per_min = rate_per_min or env("LLM_RATE_PER_MIN", "15")
+        self.bucket = TokenBucket(rate_per_min / 60, burst or env("LLM_BURST", "3"))
+        self.max_concurrency = max_concurrency or env("LLM_MAX_CONCURRENCY", "4", int)
+        self.max_retries = max_retries if max_retries is not None else env("LLM_MAX_RETRIES", "5", int)
+        self.backoff_base = backoff_base or env("LLM_BACKOFF_BASE", "1")
+        self.backoff_max = backoff_max or env("LLM_BACKOFF_MAX", "30")
+
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._async_slots = None
+
+    def _count(self, outcome):
+        metrics.inc("nl2sql_llm_requests_total", backend=type(self.backend).__name__, outcome=outcome)
+
+    def _record(self, prompt, response):
+        """Count a successful call and its (estimated) tokens; returns `response`."""
+        self._count("ok")
+        metrics.inc("nl2sql_llm_tokens_total", estimate_tokens(prompt), direction="prompt")
+        metrics.inc("nl2sql_llm_tokens_total", estimate_tokens(response), direction="completion")
+        return response
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def generate(self, prompt, model_name="gemini-2.0-flash"):
+        """Response text for `prompt` (blocking)."""
+        for attempt in range(self.max_retries + 1):
+            if self.backend.online:
+                self.bucket.acquire()
+            try:
+                with self._slots:
+                    return self._record(prompt, self.backend.generate(prompt, model_name))
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    self._count("error")
+                    raise
+                self._count("retry")
+                delay = self.backoff(attempt)
+                print(f"[LLM] {type(e).__name__} ({e.code}); retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+
+    async def generate_async(self, prompt, model_name="gemini-2.0-flash"):
+        """Response text for `prompt` without blocking the event loop."""
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrency)
+        for attempt in range(self.max_retries + 1):
+            if self.backend.online:
+                await self.bucket.acquire_async()
+            try:
+                async with self._async_slots:
+                    return self._record(prompt, await self.backend.generate_async(prompt, model_name))
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    self._count("error")
+                    raise
+                self._count("retry")
+                delay = self.backoff(attempt)
+                print(f"[LLM] {type(e).__name__} ({e.code}); retry {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Process-wide LLMClient (backend from LLM_BACKEND), configured by LLM_RATE_PER_MIN (default 15),
+    LLM_BURST (3), LLM_MAX_CONCURRENCY (4), LLM_MAX_RETRIES (5),
+    LLM_BACKOFF_BASE (1s) and LLM_BACKOFF_MAX (30s).
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient()
+        return _client
+
+def set_client(client):
+    """Replace the process-wide client (e.g. an offline backend for benchmarks)."""
+    global _client
+    with _client_lock:
+        _client = client
@@ -1,10 +1,163 @@
+"""
+Structured query log: one JSON object per line (question, SQL, row count,
+cache status, stage timings, ...), written by a background thread so the
+request path only pays for a queue put.
 
+    log_query(question, sql, (json_result, ascii_result), cached=False)
+
+Records go through a bounded queue and are written in batches; when the
+queue is full new records are dropped (and counted) rather than blocking
+requests. The file is rotated by size (query_log.jsonl.1, .2, ...),
+optionally gzip-compressed.
+"""
+import atexit
 import datetime
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+import metrics
+
+_STOP = object()
+
+
+class QueryLogger:
+    """Background JSONL writer with batching and size-based rotation."""
+
+    def __init__(self, filename="query_log.jsonl", max_bytes=10 * 1024 * 1024, backups=5,
+                 compress=False, queue_size=10000, batch_size=256):
+        self.path = Path(filename)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name="query-logger", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls):
+        """
+        QUERY_LOG_FILE (default query_log.jsonl), QUERY_LOG_MAX_BYTES (10 MiB,
+        0 = never rotate), QUERY_LOG_BACKUPS (5), QUERY_LOG_COMPRESS (false),
+        QUERY_LOG_QUEUE (10000 records).
+        """
+        return cls(
+            filename=os.getenv("QUERY_LOG_FILE", "query_log.jsonl"),
+            max_bytes=int(os.getenv("QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+            backups=int(os.getenv("QUERY_LOG_BACKUPS", "5")),
+            compress=os.getenv("QUERY_LOG_COMPRESS", "").lower() in ("1", "true", "yes"),
+            queue_size=int(os.getenv("QUERY_LOG_QUEUE", "10000")),
+        )
+
+    def log(self, record):
+        """Queue `record` (a JSON-serialisable dict); False if it was dropped."""
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("nl2sql_log_dropped_total")
+            return False
+
+    def close(self, timeout=5):
+        """Write out everything queued, then stop the thread."""
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+
+    # ----------------------------
+    # Writer thread
+    # ----------------------------
+    def _run(self):
+        while True:
+            # Block for one record, then take whatever else is waiting (one write per batch)
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = _STOP in batch
+            records = [r for r in batch if r is not _STOP]
+            if records:
+                try:
+                    self._write(records)
+                except Exception as e:   # never let a bad record or full disk kill the thread
+                    print(f"[LOG] ❌ Failed to write {len(records)} record(s): {e}")
+            if stop:
+                if self._file:
+                    self._file.close()
+                return
+
+    def _write(self, records):
+        data = "".join(json.dumps(r, default=str, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "ab")
+        if self.max_bytes and self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _backup(self, n):
+        return self.path.with_name(f"{self.path.name}.{n}" + (".gz" if self.compress else ""))
+
+    def _rotate(self):
+        """query_log.jsonl -> .1 (gzipped when compress is set), .1 -> .2, ...; oldest beyond `backups` deleted."""
+        self._file.close()
+        if self.backups:
+            self._backup(self.backups).unlink(missing_ok=True)
+            for n in range(self.backups - 1, 0, -1):
+                if self._backup(n).exists():
+                    os.replace(self._backup(n), self._backup(n + 1))
+            if self.compress:
+                with open(self.path, "rb") as src, gzip.open(self._backup(1), "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                self.path.unlink()
+            else:
+                os.replace(self.path, self._backup(1))
+        else:
+            self.path.unlink()
+        self._file = open(self.path, "ab")
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+def get_logger():
+    """Process-wide QueryLogger (see QueryLogger.from_env), flushed at exit."""
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            _logger = QueryLogger.from_env()
+            atexit.register(_logger.close)
+        return _logger
 
-def log_query(question, sql, result, filename="query_log.txt"):
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(f"\n[{datetime.datetime.now()}]\n")
-        f.write(f"Q: {question}\n")
-        f.write(f"SQL: {sql}\n")
-        f.write(f"Result:\n{result}\n")
-        f.write("="*50 + "\n")
+def log_query(question, sql, result=None, cached=None, timings=None, **fields):
+    """
+    Queue one structured record; returns immediately. `result` is
+    (json_result, ascii_result) or the result text: the record keeps the
+    row count and any error, not the rows. `timings` defaults to the
+    current request's stage timings (metrics.span); extra keyword
+    arguments (session_id, explanation, ...) are stored as-is.
+    """
+    record = {"ts": datetime.datetime.now().isoformat(timespec="milliseconds"),
+              "question": question, "sql": sql, "cached": cached}
+    text = result[1] if isinstance(result, tuple) else result
+    if isinstance(result, tuple):
+        record["row_count"] = len(result[0])
+    if isinstance(text, str) and text.startswith(("❌", "⚠️")):
+        record["error"] = text
+    if timings is None:
+        timings = metrics.request_timings()
+    if timings:
+        record["timings_ms"] = {stage: round(ms, 1) for stage, ms in timings.items()}
+    record.update(fields)
+    return get_logger().log(record)
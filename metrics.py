@@ -0,0 +1,139 @@
+"""
+In-process metrics: stage timings and counters, rendered in the Prometheus
+text format for api.py's /metrics endpoint.
+
+    with span("retrieve"):            # observed into nl2sql_stage_seconds{stage="retrieve"}
+        ...
+    inc("nl2sql_cache_lookups_total", tier="exact", result="hit")
+
+Spans also record into the current request's timings (see start_request),
+which api.py can return as a Server-Timing header.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; LLM calls sit in the upper buckets, cache/validation in the lower ones
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    "nl2sql_stage_seconds": ("histogram", "Time spent per pipeline stage."),
+    "nl2sql_requests_total": ("counter", "Requests per endpoint."),
+    "nl2sql_cache_lookups_total": ("counter", "Query cache lookups by tier (exact / semantic) and result (hit / miss); semantic lookups are exact-tier misses."),
+    "nl2sql_result_cache_lookups_total": ("counter", "SQL result cache lookups by result (hit / miss)."),
+    "nl2sql_sql_repairs_total": ("counter", "Generated SQL by validation path (prechecked, local_fixes, needs_llm, llm_repairs)."),
+    "nl2sql_llm_requests_total": ("counter", "LLM calls by backend and outcome."),
+    "nl2sql_llm_tokens_total": ("counter", "LLM tokens by direction (estimated at ~4 characters per token)."),
+    "nl2sql_log_dropped_total": ("counter", "Query log records dropped because the log queue was full."),
+}
+
+_lock = threading.Lock()
+_counters = {}      # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+_collectors = []    # callables returning [(name, labels dict, value)] at scrape time
+
+_request_timings = contextvars.ContextVar("nl2sql_request_timings", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add `value` to counter `name` with `labels`."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Record one observation in histogram `name`."""
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        i = bisect.bisect_left(BUCKETS, seconds)
+        if i < len(BUCKETS):
+            h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+
+def register_collector(fn):
+    """`fn()` -> [(counter name, labels, value)], read on every render (for counts kept elsewhere)."""
+    _collectors.append(fn)
+
+
+def start_request():
+    """Collect this request's span timings (ms) into a fresh dict, which is returned."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def request_timings():
+    """The current request's span timings so far ({stage: ms}), or {} outside a request."""
+    return dict(_request_timings.get() or {})
+
+
+def record(stage, seconds):
+    """Report a stage duration measured by the caller (e.g. summed over several calls)."""
+    observe("nl2sql_stage_seconds", seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + seconds * 1000
+
+
+@contextmanager
+def span(stage):
+    """Time a pipeline stage (works around sync code and awaits alike)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def server_timing(timings):
+    """Server-Timing header value, e.g. 'retrieve;dur=1.2, generate;dur=310.5'."""
+    return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in timings.items())
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    for fn in _collectors:
+        for name, labels, value in fn():
+            counters[_key(name, labels)] = value
+
+    lines, seen = [], set()
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, text = HELP.get(name, ("counter", name))
+            lines.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name)
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), h in sorted(histograms.items()):
+        header(name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, h):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+        lines.append(f"{name}_sum{_labels(labels)} {h[-2]}")
+        lines.append(f"{name}_count{_labels(labels)} {h[-1]}")
+    return "\n".join(lines) + "\n"
@@ -4,16 +4,18 @@ from dotenv import load_dotenv
 
 from cache_manager import QueryCache
 from context_manager import ContextManager
-from db import get_connection, extract_schema
+from db import get_connection, SchemaCatalog, ChangeTracker
 from retriever import SchemaRetriever
+from profiler import StatsCatalog
+from llm_client import get_client
 from query_engine import configure_gemini, nl_to_sql, run_sql
-from validator import repair_sql
+from validator import prepare_sql, repair_sql
 from explainer import explain_result
 from logger import log_query
 
 load_dotenv()
 api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
+if not api_key and get_client().backend.online:   # stub/replay backends run offline
     raise ValueError("❌ GOOGLE_API_KEY not found. Please set it in .env")
 
 configure_gemini(api_key)
@@ -21,8 +23,10 @@ configure_gemini(api_key)
 DB_NAME = "demo1.db"
 conn = get_connection(DB_NAME)
 cursor = conn.cursor()
-schema_info = extract_schema(DB_NAME)
-retriever = SchemaRetriever(schema_info)
+schema = SchemaCatalog(DB_NAME)
+schema_info = schema.schema_info
+retriever = SchemaRetriever(schema_info, tables=schema.tables)
+stats = StatsCatalog(DB_NAME)
 def normalize_for_cache(enriched_question):
     if "Follow-up question:" in enriched_question:
         return enriched_question.split("Follow-up question:")[-1].strip()
@@ -33,7 +37,7 @@ def normalize(text):
     return text
 if __name__ == "__main__":
     context = ContextManager()
-    cache = QueryCache()
+    cache = QueryCache.from_env(tracker=ChangeTracker(DB_NAME))
 
     print("💬 Ask me questions about the database (type 'exit' to quit)")
     while True:
@@ -55,16 +59,18 @@ if __name__ == "__main__":
             print("📝 Explanation:", explanation)
 
             context.add_entry(question, sql, result)
-            log_query(question, sql, result + "\nExplanation: " + explanation)
+            log_query(question, sql, result, cached=True, explanation=explanation)
             continue
 
-        sql = nl_to_sql(enriched_question, retriever)
+        sql = nl_to_sql(enriched_question, retriever, stats=stats)
+        sql, _ = prepare_sql(cursor, sql, schema_info)   # local fixes before any LLM repair
         print("Generated SQL:", sql)
 
         result = run_sql(cursor, sql)
 
         if result.startswith("❌ Error"):
             fixed_sql = repair_sql(question, sql, result, schema_info)
+            fixed_sql, _ = prepare_sql(cursor, fixed_sql, schema_info)
             print("🔧 Fixed SQL:", fixed_sql)
             result = run_sql(cursor, fixed_sql)
             sql = fixed_sql  
@@ -76,4 +82,4 @@ if __name__ == "__main__":
 
         context.add_entry(question, sql, result)
         cache.add(cache_key, sql, result)
-        log_query(question, sql, result + "\nExplanation: " + explanation)
+        log_query(question, sql, result, cached=False, explanation=explanation)
@@ -0,0 +1,180 @@
+"""
+Offline column profiler: per-column statistics the SQL prompt can use
+(distinct counts, min/max, most common values, date formats), so the model
+writes literals that match the data instead of guessing.
+
+Usage:
+    python profiler.py [--db demo1.db] [--top 5] [--full]
+
+Results go to a compact JSON catalog next to the schema catalog
+(SCHEMA_CACHE_DIR/stats.json). Re-running only profiles tables whose schema
+or data changed since the last pass.
+"""
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+from db import TRACKING_TABLE, list_tables, read_table, tables_from_schema
+
+DATE_FORMATS = {
+    "%Y-%m-%d": "YYYY-MM-DD",
+    "%Y-%m-%d %H:%M:%S": "YYYY-MM-DD HH:MM:SS",
+    "%Y-%m-%dT%H:%M:%S": "YYYY-MM-DDTHH:MM:SS",
+    "%Y/%m/%d": "YYYY/MM/DD",
+    "%d/%m/%Y": "DD/MM/YYYY",
+    "%m/%d/%Y": "MM/DD/YYYY",
+    "%d-%m-%Y": "DD-MM-YYYY",
+}
+MAX_VALUE_CHARS = 40
+
+def detect_date_format(values):
+    """Readable date format shared by all `values` (strings), or None."""
+    values = [v for v in values if isinstance(v, str)]
+    if not values:
+        return None
+    for fmt, readable in DATE_FORMATS.items():
+        try:
+            for v in values:
+                datetime.strptime(v, fmt)
+        except ValueError:
+            continue
+        return readable
+    return None
+
+def profile_column(cursor, table, column, top_n=5):
+    """Stats for one column: distinct, nulls, min, max, top values, date format."""
+    rows, distinct, nulls, low, high = cursor.execute(
+        f'SELECT COUNT(*), COUNT(DISTINCT "{column}"), SUM("{column}" IS NULL), '
+        f'MIN("{column}"), MAX("{column}") FROM "{table}";'
+    ).fetchone()
+    stats = {"distinct": distinct, "nulls": nulls or 0, "min": low, "max": high, "top": [], "date_format": None}
+
+    # Most common values only say something when values repeat
+    if distinct and distinct < rows - (nulls or 0):
+        stats["top"] = [v for v, _ in cursor.execute(
+            f'SELECT "{column}", COUNT(*) AS n FROM "{table}" WHERE "{column}" IS NOT NULL '
+            f'GROUP BY "{column}" ORDER BY n DESC LIMIT ?;', (top_n,)
+        ).fetchall()]
+
+    sample = [v for (v,) in cursor.execute(
+        f'SELECT "{column}" FROM "{table}" WHERE "{column}" IS NOT NULL LIMIT 20;'
+    ).fetchall()]
+    stats["date_format"] = detect_date_format(sample)
+
+    for key in ("min", "max"):
+        if isinstance(stats[key], str):
+            stats[key] = stats[key][:MAX_VALUE_CHARS]
+    stats["top"] = [v[:MAX_VALUE_CHARS] if isinstance(v, str) else v for v in stats["top"]]
+    return stats
+
+def _quote(value):
+    return f"'{value}'" if isinstance(value, str) else str(value)
+
+def describe_column(table, column, stats):
+    """One prompt line, e.g. "customers.city: 2 distinct; common values 'New York', 'Boston'"."""
+    parts = [f"{stats['distinct']} distinct"]
+    if stats["date_format"]:
+        parts.append(f"dates as {stats['date_format']}")
+    if stats["min"] is not None and not stats["top"]:
+        parts.append(f"range {_quote(stats['min'])} to {_quote(stats['max'])}")
+    if stats["top"]:
+        parts.append("common values " + ", ".join(_quote(v) for v in stats["top"]))
+    if stats["nulls"]:
+        parts.append(f"{stats['nulls']} NULL")
+    return f"{table}.{column}: " + "; ".join(parts)
+
+class StatsCatalog:
+    """
+    On-disk column statistics for one database.
+
+    Each table entry records the CREATE statement and data version it was
+    profiled at (the change-tracking counter when installed, otherwise the
+    row count), so refresh() only re-profiles tables that changed. Serving
+    processes just load() the file and call notes().
+    """
+
+    def __init__(self, db_name="demo1.db", cache_dir=None, top_n=5):
+        if cache_dir is None:
+            cache_dir = os.getenv("SCHEMA_CACHE_DIR", "schema_cache")
+        self.db_name = db_name
+        self.path = Path(cache_dir) / "stats.json" if cache_dir else None
+        self.top_n = top_n
+        self.tables = {}
+        self.load()
+
+    def load(self):
+        if not (self.path and self.path.exists()):
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("db") == str(Path(self.db_name).resolve()):
+            self.tables = data["tables"]
+
+    def save(self):
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"db": str(Path(self.db_name).resolve()), "tables": self.tables},
+                                  default=str), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def refresh(self, full=False):
+        """Profile added/changed tables (all with full=True). Returns the tables profiled."""
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        fingerprints = dict(cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table';").fetchall())
+        tracked = TRACKING_TABLE in fingerprints
+        counters = dict(cursor.execute(f"SELECT table_name, version FROM {TRACKING_TABLE};").fetchall()) if tracked else {}
+
+        profiled = []
+        current = [t for t in list_tables(cursor) if not t.startswith("sqlite_")]
+        for table in current:
+            if tracked and table in counters:
+                version = counters[table]
+            else:
+                version = cursor.execute(f'SELECT COUNT(*) FROM "{table}";').fetchone()[0]
+            entry = self.tables.get(table)
+            if not full and entry and entry["fingerprint"] == fingerprints[table] and entry["version"] == version:
+                continue
+            columns = {col: profile_column(cursor, table, col, self.top_n)
+                       for col, _ in read_table(cursor, table)["columns"]}
+            self.tables[table] = {"fingerprint": fingerprints[table], "version": version, "columns": columns}
+            profiled.append(table)
+
+        for table in set(self.tables) - set(current):
+            del self.tables[table]
+        conn.close()
+        self.save()
+        return profiled
+
+    def notes(self, relevant_schema):
+        """Prompt lines for the columns present in `relevant_schema` (retriever output)."""
+        lines = []
+        for table, info in tables_from_schema(relevant_schema).items():
+            columns = self.tables.get(table, {}).get("columns", {})
+            for col, _ in info["columns"]:
+                if col in columns:
+                    lines.append(describe_column(table, col, columns[col]))
+        return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile columns for NL2SQL prompts")
+    parser.add_argument("--db", default="demo1.db")
+    parser.add_argument("--top", type=int, default=5, help="most common values kept per column")
+    parser.add_argument("--full", action="store_true", help="re-profile every table")
+    args = parser.parse_args()
+
+    catalog = StatsCatalog(args.db, top_n=args.top)
+    profiled = catalog.refresh(full=args.full)
+    print(f"✅ Profiled {len(profiled)} table(s): {', '.join(profiled) or 'none changed'} → {catalog.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,22 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
 import google.generativeai as genai
 from tabulate import tabulate
 
+from llm_client import get_client
+
+# Row cap for a single result page (LLM-generated SELECT * can be huge)
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000"))
+# Signs continuation tokens; set it when several workers serve /page
+_PAGE_SECRET = os.getenv("PAGE_TOKEN_SECRET", "").encode() or secrets.token_bytes(32)
+
 # ----------------------------
 # Configure Gemini
 # ----------------------------
@@ -11,19 +27,24 @@ def configure_gemini(api_key):
 # ----------------------------
 # Natural Language → SQL
 # ----------------------------
-def nl_to_sql(nl_query, retriever, model_name="gemini-2.0-flash"):
+def build_sql_prompt(nl_query, relevant_schema, column_notes=None):
     """
-    Translate natural language to SQL using Gemini + schema retriever.
+    Prompt asking Gemini to translate `nl_query` using only `relevant_schema`.
+    `column_notes` (profiler.StatsCatalog.notes) describe the values stored.
     """
-    relevant_schema = retriever.retrieve(nl_query)
     schema_text = "\n".join(relevant_schema)
+    notes_text = ""
+    if column_notes:
+        notes_text = "Column values (from the data; match these spellings and formats):\n" + "\n".join(column_notes)
 
-    prompt = f"""
+    return f"""
     You are an assistant that translates natural language to SQL.
     Use only the following schema:
 
     {schema_text}
 
+    {notes_text}
+
     Rules:
     - Always use single quotes for strings.
     - Always make string comparisons case-insensitive (use LOWER()).
@@ -34,51 +55,205 @@ def nl_to_sql(nl_query, retriever, model_name="gemini-2.0-flash"):
     SQL Query:
     """
 
-    model = genai.GenerativeModel(model_name)
-    response = model.generate_content(prompt)
-    sql_query = response.text.strip()
-
-    # --- Cleanup ---
+def clean_sql(text):
+    """Strip markdown fences and make sure the query ends with a semicolon."""
+    sql_query = text.strip()
     if "```" in sql_query:
         sql_query = sql_query.replace("```sql", "").replace("```", "")
     sql_query = sql_query.strip()
     if not sql_query.endswith(";"):
         sql_query += ";"
-
     return sql_query
 
+def nl_to_sql(nl_query, retriever, model_name="gemini-2.0-flash", stats=None):
+    """
+    Translate natural language to SQL using Gemini + schema retriever.
+    `stats` (profiler.StatsCatalog) adds value notes for the retrieved columns.
+    """
+    relevant_schema = retriever.retrieve(nl_query)
+    prompt = build_sql_prompt(nl_query, relevant_schema, stats.notes(relevant_schema) if stats else None)
+
+    return clean_sql(get_client().generate(prompt, model_name))
+
+async def nl_to_sql_async(nl_query, retriever, model_name="gemini-2.0-flash", relevant_schema=None, stats=None):
+    """
+    Async nl_to_sql: retrieval runs in a worker thread and the Gemini call
+    uses the shared async client. Pass `relevant_schema` if it was already retrieved.
+    """
+    if relevant_schema is None:
+        relevant_schema = await asyncio.to_thread(retriever.retrieve, nl_query)
+    prompt = build_sql_prompt(nl_query, relevant_schema, stats.notes(relevant_schema) if stats else None)
+
+    return clean_sql(await get_client().generate_async(prompt, model_name))
+
 # ----------------------------
 # Run SQL Query
 # ----------------------------
-def run_sql(cursor, sql_query):
+def format_result(col_names, rows):
     """
-    Run SQL query against DB cursor.
-    Returns:
-        (json_result, ascii_result)
-    - json_result: list of dicts (for Streamlit / UI)
-        e.g. [ {"name": "Alice", "sales": 1200}, {"name": "Bob", "sales": 800} ]
-    - ascii_result: pretty table string (for logs/debug)
+    Build (json_result, ascii_result) from column names + fetched rows.
     """
-    if sql_query is None:
-        return [], "⚠️ Model did not generate a valid SQL query."
+    if not rows:
+        return [], "⚠️ No results found."
 
-    try:
-        cursor.execute(sql_query)
-        rows = cursor.fetchall()
+    # Structured JSON result
+    json_result = [dict(zip(col_names, row)) for row in rows]
+
+    # ASCII table
+    ascii_result = tabulate(rows, headers=col_names, tablefmt="psql")
+
+    return json_result, ascii_result
+
+class ExecutionBudget:
+    """
+    Limits for running one LLM-generated query:
+    - timeout   : seconds spent inside SQLite (waiting on the client is free)
+    - max_steps : SQLite VM instructions, counted by the progress handler
+    Defaults come from SQL_TIMEOUT_SECONDS and SQL_MAX_VM_STEPS (0 disables
+    a limit). Rows handed back are already capped per page by SQL_MAX_ROWS;
+    rows skipped to reach a page cost time and VM steps like any other work.
+    """
+
+    def __init__(self, timeout=None, max_steps=None, check_every=1000):
+        self.timeout = timeout if timeout is not None else float(os.getenv("SQL_TIMEOUT_SECONDS", "10"))
+        self.max_steps = max_steps if max_steps is not None else int(os.getenv("SQL_MAX_VM_STEPS", "200000000"))
+        self.check_every = check_every
+
+    def guard(self, conn):
+        """Fresh per-query enforcement state for `conn`."""
+        return BudgetGuard(self, conn)
+
+class BudgetGuard:
+    """
+    Enforces an ExecutionBudget on one query. Run every SQLite call for the
+    query through execute()/fetch(); the progress handler is installed only
+    for the duration of each call, so one guard can span several fetches.
+    """
+
+    def __init__(self, budget, conn):
+        self.budget = budget
+        self.conn = conn
+        self.elapsed = 0.0
+        self.steps = 0
+        self.reason = None
+
+    def _call(self, fn, *args):
+        start = time.monotonic()
 
-        if not rows:
-            return [], "⚠️ No results found."
+        def progress():
+            self.steps += self.budget.check_every
+            if self.budget.max_steps and self.steps > self.budget.max_steps:
+                self.reason = f"used more than {self.budget.max_steps:,} SQLite VM steps"
+                return 1
+            if self.budget.timeout and self.elapsed + time.monotonic() - start > self.budget.timeout:
+                self.reason = f"ran longer than {self.budget.timeout:g}s"
+                return 1
+            return 0
 
-        # Column names
-        col_names = [desc[0] for desc in cursor.description]
+        self.conn.set_progress_handler(progress, self.budget.check_every)
+        try:
+            return fn(*args)
+        finally:
+            self.conn.set_progress_handler(None, 0)
+            self.elapsed += time.monotonic() - start
 
-        # Structured JSON result
-        json_result = [dict(zip(col_names, row)) for row in rows]
+    def execute(self, cursor, sql_query):
+        """start_sql() under the budget; returns column names."""
+        return self._call(start_sql, cursor, sql_query)
 
-        # ASCII table
-        ascii_result = tabulate(rows, headers=col_names, tablefmt="psql")
+    def fetch(self, cursor, n):
+        """cursor.fetchmany(n) under the budget."""
+        return self._call(cursor.fetchmany, n)
 
-        return json_result, ascii_result
+    def error_message(self, error):
+        """
+        Result text for a failed query. Budget overruns read as SQL errors
+        with a hint, so the pipeline hands them to repair_sql like any other.
+        """
+        if self.reason:
+            return (f"❌ Error running SQL: execution budget exceeded (query {self.reason}). "
+                    "Rewrite it to be cheaper: add filters, avoid cross joins, aggregate or LIMIT.")
+        return f"❌ Error running SQL: {error}"
 
+def start_sql(cursor, sql_query):
+    """
+    Execute SQL without fetching; returns column names.
+    Rows are then pulled with cursor.fetchmany(). Raises on SQL errors.
+    """
+    cursor.execute(sql_query)
+    return [desc[0] for desc in cursor.description or []]
+
+def make_page_token(sql_query, offset):
+    """Opaque, signed continuation token for the rows of `sql_query` from `offset`."""
+    payload = base64.urlsafe_b64encode(json.dumps({"sql": sql_query, "offset": offset}).encode()).decode()
+    signature = hmac.new(_PAGE_SECRET, payload.encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{payload}.{signature}"
+
+def parse_page_token(token):
+    """Returns (sql_query, offset); raises ValueError if the token was not issued here."""
+    payload, _, signature = token.rpartition(".")
+    expected = hmac.new(_PAGE_SECRET, payload.encode(), hashlib.sha256).hexdigest()[:32]
+    if not payload or not hmac.compare_digest(signature, expected):
+        raise ValueError("Invalid page token")
+    data = json.loads(base64.urlsafe_b64decode(payload.encode()))
+    return data["sql"], int(data["offset"])
+
+def run_sql_page(cursor, sql_query, limit=SQL_MAX_ROWS, offset=0, budget=None, results=None):
+    """
+    Run SQL and fetch one page of at most `limit` rows starting at `offset`.
+    Rows are pulled with fetchmany, so memory is bounded by the page size,
+    and execution is bounded by `budget` (default ExecutionBudget()).
+    With `results` (cache_manager.ResultCache) a page already fetched for
+    the same canonical SQL and unchanged tables is returned without running it.
+    Returns:
+        (json_result, ascii_result, next_token)
+    - ascii_result covers this page only
+    - next_token: pass to run_sql_page via parse_page_token() for the next
+      page, or None when this was the last one
+    """
+    if sql_query is None:
+        return [], "⚠️ Model did not generate a valid SQL query.", None
+    versions = None
+    if results is not None:
+        versions = results.snapshot(sql_query)
+        page = results.get(sql_query, limit, offset) if versions is not None else None
+        if page is not None:
+            return page
+
+    guard = (budget or ExecutionBudget()).guard(cursor.connection)
+    try:
+        col_names = guard.execute(cursor, sql_query)
+        skipped = 0
+        while skipped < offset:
+            chunk = guard.fetch(cursor, min(offset - skipped, 500))
+            if not chunk:
+                break
+            skipped += len(chunk)
+        rows = guard.fetch(cursor, limit + 1)   # one extra row tells us if there is more
     except Exception as e:
-        return [], f"❌ Error running SQL: {e}"
+        return [], guard.error_message(e), None
+
+    next_token = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_token = make_page_token(sql_query, offset + limit)
+
+    json_result, ascii_result = format_result(col_names, rows)
+    if versions is not None:
+        results.put(sql_query, limit, offset, (json_result, ascii_result, next_token), versions)
+    return json_result, ascii_result, next_token
+
+def run_sql(cursor, sql_query, max_rows=SQL_MAX_ROWS, budget=None, results=None):
+    """
+    Run SQL query against DB cursor (at most `max_rows` rows are returned).
+    Returns:
+        (json_result, ascii_result)
+    - json_result: list of dicts (for Streamlit / UI)
+        e.g. [ {"name": "Alice", "sales": 1200}, {"name": "Bob", "sales": 800} ]
+    - ascii_result: pretty table string (for logs/debug)
+    """
+    json_result, ascii_result, next_token = run_sql_page(cursor, sql_query, limit=max_rows, budget=budget,
+                                                         results=results)
+    if next_token:
+        ascii_result += f"\n(showing the first {max_rows} rows; more rows available)"
+    return json_result, ascii_result
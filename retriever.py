@@ -1,19 +1,248 @@
-from sentence_transformers import SentenceTransformer
+import json
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+
 import faiss
 import numpy as np
 
+from context_manager import estimate_tokens
+from db import format_table, tables_from_schema
+from embeddings import DEFAULT_MODEL, get_embedder
+
 class SchemaRetriever:
-    """Embeds schema info, retrieves relevant parts for queries."""
+    """
+    Embeds schema info, retrieves relevant parts for queries.
+
+    Every table and every column is its own document, so a question about
+    one column of a wide table still finds it. Small schemas use an exact
+    IndexFlatL2; past `ann_threshold` documents an HNSW index (8-bit scalar
+    quantised) keeps search sub-linear and memory ~4x smaller. The best
+    tables are expanded along foreign keys so join partners come along, and
+    the returned schema text is cut to `max_tokens`, keeping matched and key
+    columns of wide tables first.
 
-    def __init__(self, schema_info, model_name="all-MiniLM-L6-v2"):
+    Document vectors and the index are persisted to `cache_dir`
+    (SCHEMA_CACHE_DIR, default "schema_cache"; empty disables): a restart
+    on an unchanged schema encodes nothing, and update() re-embeds only
+    the tables that changed.
+    """
+
+    def __init__(self, schema_info, model_name=DEFAULT_MODEL, tables=None, max_tokens=None,
+                 ann_threshold=None, embedder=None, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.getenv("SCHEMA_CACHE_DIR", "schema_cache")
         self.schema_info = schema_info
-        self.model = SentenceTransformer(model_name)
+        self.tables = tables if tables is not None else tables_from_schema(schema_info)
+        self.model_name = model_name
+        self.max_tokens = max_tokens or int(os.getenv("SCHEMA_MAX_TOKENS", "2000"))
+        self.ann_threshold = ann_threshold or int(os.getenv("SCHEMA_ANN_THRESHOLD", "50000"))
+        self.embedder = embedder or get_embedder(model_name)
+        # Persisted vectors are only reusable with the embedder that produced them
+        self.embedder_id = (getattr(self.embedder, "model_name", None)
+                            or f"{type(self.embedder).__module__}.{type(self.embedder).__qualname__}")
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.lock = threading.RLock()
+
+        docs, texts = self._documents(self.tables)
+        if self._load():
+            # Tables changed while we were down: patch the stored index
+            self._link()
+            changed, removed = self._diff(docs, texts)
+            if changed or removed:
+                self.update(self.tables, changed, removed)
+        else:
+            self.docs, self.texts = docs, texts
+            self.vectors = self._encode(texts, {})
+            self.index = self._build_index(self.vectors)
+            self._link()
+            self._save()
+
+    # ----------------------------
+    # Documents and persistence
+    # ----------------------------
+    @staticmethod
+    def _documents(tables):
+        """Documents (table, column or None) and the text embedded for each."""
+        docs, texts = [], []
+        for table, info in tables.items():
+            docs.append((table, None))
+            texts.append(format_table(table, info))
+            for col, kind in info["columns"]:
+                docs.append((table, col))
+                texts.append(f"{table}.{col} ({kind}) column of table {table}")
+        return docs, texts
+
+    def _files(self):
+        return self.cache_dir / "docs.json", self.cache_dir / "vectors.npy", self.cache_dir / "index.faiss"
+
+    def _read_meta(self):
+        if not self.cache_dir:
+            return None
+        meta_path, vectors_path, _ = self._files()
+        if not (meta_path.exists() and vectors_path.exists()):
+            return None
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get("model") == self.embedder_id else None
+
+    def _load(self):
+        """Adopt the persisted documents, vectors and index."""
+        meta = self._read_meta()
+        if meta is None or not self._files()[2].exists():
+            return False
+        self.docs = [tuple(d) if d else None for d in meta["docs"]]
+        self.texts = meta["texts"]
+        self.vectors = np.load(self._files()[1])
+        self.index = faiss.read_index(str(self._files()[2]))
+        print(f"[SCHEMA] Loaded {sum(d is not None for d in self.docs)} schema embeddings from {self.cache_dir}")
+        return True
+
+    def _diff(self, docs, texts):
+        """(changed, removed) tables between the loaded documents and `docs`/`texts`."""
+        def by_table(docs, texts):
+            grouped = defaultdict(set)
+            for doc, text in zip(docs, texts):
+                if doc is not None:
+                    grouped[doc[0]].add(text)
+            return grouped
+        stored, current = by_table(self.docs, self.texts), by_table(docs, texts)
+        changed = {t for t in current if stored.get(t) != current[t]}
+        return changed, set(stored) - set(current)
+
+    def _save(self):
+        if not self.cache_dir:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        meta_path, vectors_path, index_path = self._files()
+        np.save(vectors_path, self.vectors)
+        faiss.write_index(self.index, str(index_path))
+        meta_path.write_text(json.dumps({"model": self.embedder_id, "docs": self.docs, "texts": self.texts}),
+                             encoding="utf-8")
+
+    def _encode(self, texts, stored):
+        """Unit vectors for `texts`, reusing `stored` ones and encoding only the rest."""
+        missing = [t for t in dict.fromkeys(texts) if t not in stored]
+        if missing:
+            print(f"[SCHEMA] Embedding {len(missing)} schema document(s)")
+            encoded = np.ascontiguousarray(self.embedder.encode(missing, memo=False), dtype="float32")
+            faiss.normalize_L2(encoded)   # L2 on unit vectors ranks like cosine
+            stored = {**stored, **dict(zip(missing, encoded))}
+        return np.stack([stored[t] for t in texts]).astype("float32")
 
-        embeddings = self.model.encode(schema_info).astype("float32")
-        self.index = faiss.IndexFlatL2(embeddings.shape[1])
-        self.index.add(embeddings)
+    def _build_index(self, vectors):
+        dim = vectors.shape[1]
+        if len(vectors) < self.ann_threshold:
+            index = faiss.IndexFlatL2(dim)
+        else:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, 32)
+            index.hnsw.efConstruction = 40
+            index.hnsw.efSearch = 128
+            sample = np.random.default_rng(0).choice(len(vectors), min(len(vectors), 100000), replace=False)
+            index.train(vectors[sample])
+        index.add(vectors)
+        return index
 
+    def _link(self):
+        """Join graph: outgoing FK targets and incoming referrers per table."""
+        self.references = defaultdict(set)
+        self.referenced_by = defaultdict(set)
+        for table, info in self.tables.items():
+            for _, ref_table, _ in info["foreign_keys"]:
+                if ref_table in self.tables and ref_table != table:
+                    self.references[table].add(ref_table)
+                    self.referenced_by[ref_table].add(table)
+
+    def update(self, tables, changed, removed):
+        """
+        Apply a schema change (see db.SchemaCatalog.refresh): documents of
+        changed/removed tables are retired and the changed tables' new
+        documents appended, so only those are embedded. The index is
+        rebuilt once retired documents outnumber live ones.
+        """
+        docs, texts = self._documents({t: tables[t] for t in changed if t in tables})
+        vectors = None
+        if texts:
+            with self.lock:
+                stored = {t: self.vectors[i] for i, t in enumerate(self.texts) if t is not None}
+            vectors = self._encode(texts, stored)
+
+        with self.lock:
+            gone = set(changed) | set(removed)
+            for i, doc in enumerate(self.docs):
+                if doc is not None and doc[0] in gone:
+                    self.docs[i] = self.texts[i] = None
+            self.docs.extend(docs)
+            self.texts.extend(texts)
+            if vectors is not None:
+                self.vectors = np.vstack([self.vectors, vectors])
+                self.index.add(vectors)
+
+            live = [i for i, d in enumerate(self.docs) if d is not None]
+            if len(self.docs) - len(live) > len(live):
+                self.docs = [self.docs[i] for i in live]
+                self.texts = [self.texts[i] for i in live]
+                self.vectors = self.vectors[live]
+                self.index = self._build_index(self.vectors)
+
+            self.tables = tables
+            self.schema_info = [format_table(name, info) for name, info in tables.items()]
+            self._link()
+            self._save()
+
+    # ----------------------------
+    # Retrieval
+    # ----------------------------
     def retrieve(self, query, top_k=2):
-        query_emb = self.model.encode([query]).astype("float32")
-        D, I = self.index.search(query_emb, top_k)
-        return [self.schema_info[i] for i in I[0]]
+        """Schema lines for the `top_k` best tables plus their FK join partners, within max_tokens."""
+        query_emb = np.ascontiguousarray(self.embedder.encode([query]), dtype="float32")
+        faiss.normalize_L2(query_emb)
+
+        with self.lock:
+            D, I = self.index.search(query_emb, min(len(self.docs), max(50, top_k * 20)))
+
+            # Score tables by their best document; remember which columns matched
+            scores, matched = {}, defaultdict(list)
+            for dist, i in zip(D[0], I[0]):
+                if i < 0 or self.docs[i] is None:
+                    continue
+                table, col = self.docs[i]
+                scores[table] = max(scores.get(table, -np.inf), 1 - dist / 2)
+                if col is not None:
+                    matched[table].append(col)
+            ranked = sorted(scores, key=scores.get, reverse=True)
+
+            # FK expansion: tables the best ones reference always come along; tables
+            # referencing them only if they matched too (hub tables have many referrers)
+            chosen = ranked[:top_k]
+            for table in list(chosen):
+                partners = sorted(self.references[table]) + [t for t in ranked if t in self.referenced_by[table]]
+                chosen.extend(t for t in partners if t not in chosen)
+
+            return self._fit_budget(chosen, matched)
+
+    def _columns_for(self, table, matched):
+        """Matched columns plus key columns (id / FK) — the minimum useful for a join."""
+        info = self.tables[table]
+        fk_cols = {c for c, _, _ in info["foreign_keys"]}
+        fk_cols |= {ref_col for t in self.referenced_by[table]
+                    for _, ref_table, ref_col in self.tables[t]["foreign_keys"] if ref_table == table}
+        keep = set(matched.get(table, [])) | fk_cols
+        keep |= {c for c, _ in info["columns"] if c.lower() == "id"}
+        return keep or {c for c, _ in info["columns"][:3]}
+
+    def _fit_budget(self, chosen, matched):
+        lines, used = [], 0
+        for table in chosen:
+            line = format_table(table, self.tables[table])
+            if used + estimate_tokens(line) > self.max_tokens:
+                line = format_table(table, self.tables[table], self._columns_for(table, matched))
+            cost = estimate_tokens(line)
+            if used + cost > self.max_tokens and lines:
+                continue
+            lines.append(line)
+            used += cost
+        return lines
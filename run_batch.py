@@ -1,64 +1,144 @@
-import os, re
+"""
+Batch NL→SQL evaluation over EXPECTED.
+
+Usage:
+    python run_batch.py [--workers 4] [--checkpoint batch_checkpoint.jsonl] [--fresh]
+
+Cases run concurrently on a bounded worker pool (LLM calls are paced by the
+shared client's rate limiter). Every finished case is appended to a JSONL
+checkpoint, so an interrupted run picks up where it stopped; --fresh starts
+over. Cases that failed transiently (LLM errors after retries, a locked
+database) are re-run on resume. Scoring uses the structured json_result rows.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from pathlib import Path
+
+import numpy as np
 from dotenv import load_dotenv
 
-from db import get_connection, extract_schema
+from db import ConnectionPool, SchemaCatalog
 from retriever import SchemaRetriever
+from profiler import StatsCatalog
+from llm_client import get_client
 from query_engine import configure_gemini, nl_to_sql, run_sql
 from expected import EXPECTED
 
+DB_NAME = "demo1.db"
 OUTPUT_FILE = "output.txt"
 ACCURACY_REPORT = "accuracy_report.txt"
+CHECKPOINT_FILE = "batch_checkpoint.jsonl"
+# SQLite errors that say nothing about the generated SQL
+TRANSIENT_SQL_ERRORS = ("database is locked", "database is busy", "disk I/O error", "unable to open database")
 
 QUERIES = list(EXPECTED.keys())  # you can also append more test prompts here
 
-def parse_row_count_from_table(table_text: str):
-    lines = [ln.strip() for ln in table_text.splitlines() if ln.strip()]
-    data_rows = [ln for ln in lines if ln.startswith("|") and not set(ln) <= set("|-+")]
-    if len(data_rows) >= 2:
-        return len(data_rows) - 1   # minus header row
+def scalar_value(rows):
+    """The single value of a one-row, one-column result, else None."""
+    if len(rows) == 1 and len(rows[0]) == 1:
+        return next(iter(rows[0].values()))
     return None
 
-def parse_scalar_from_table(table_text: str):
-    nums = re.findall(r"\b\d+\b", table_text)
-    return nums[-1] if nums else None
-
-def check_case(q: str, result_text: str):
+def check_case(q: str, rows, error=None):
+    """Score a case on its json_result rows: (ok, reasons)."""
     reasons = []
     exp = EXPECTED.get(q)
     if not exp:
         return True, ["No expectation defined; skipping scoring."]
+    if error:
+        return False, [error]
 
     ok = True
-    if "row_count" in exp:
-        rc = parse_row_count_from_table(result_text)
-        if rc is None or rc != exp["row_count"]:
-            ok = False
-            reasons.append(f"Row count {rc} ≠ expected {exp['row_count']}.")
+    if "row_count" in exp and len(rows) != exp["row_count"]:
+        ok = False
+        reasons.append(f"Row count {len(rows)} ≠ expected {exp['row_count']}.")
 
     if "scalar_value" in exp:
-        sv = parse_scalar_from_table(result_text)
+        sv = scalar_value(rows)
         if sv is None or str(sv) != str(exp["scalar_value"]):
             ok = False
             reasons.append(f"Scalar value {sv} ≠ expected {exp['scalar_value']}.")
 
     if "must_include" in exp:
+        values = {str(v) for row in rows for v in row.values()}
         for token in exp["must_include"]:
-            if token not in result_text:
+            if not any(token in v for v in values):
                 ok = False
                 reasons.append(f"Missing '{token}' in result.")
 
     return ok, reasons
 
+def run_case(q, retriever, stats, pool):
+    """Generate + run + score one case; returns its checkpoint record."""
+    record = {"question": q, "sql": None, "json_result": [], "ascii_result": "", "error": None,
+              "transient": False}
+    start = time.perf_counter()
+    try:
+        record["sql"] = nl_to_sql(q, retriever, stats=stats)
+    except Exception as e:
+        record["error"] = f"Generation error: {e}"
+        record["transient"] = True   # quota / network / replay miss: not a verdict on the case
+    record["llm_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    if record["sql"]:
+        with pool.connection() as conn:
+            json_result, ascii_result = run_sql(conn.cursor(), record["sql"])
+        record["json_result"], record["ascii_result"] = json_result, ascii_result
+        if ascii_result.startswith("❌ Error"):
+            record["error"] = ascii_result
+            record["transient"] = any(m in ascii_result for m in TRANSIENT_SQL_ERRORS)
+
+    record["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    record["ok"], record["reasons"] = check_case(q, record["json_result"], record["error"])
+    return record
+
+def load_checkpoint(path):
+    """{question: record} of cases finished by an earlier run (transient failures are left to re-run)."""
+    done = {}
+    if Path(path).exists():
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue   # torn last line from a crash
+                    if record.get("transient"):
+                        done.pop(record["question"], None)
+                    else:
+                        done[record["question"]] = record
+    return done
+
 def write_block(fh, title, content):
     fh.write(f"\n{title}\n")
     fh.write("-" * max(12, len(title)) + "\n")
     fh.write((content or "") + "\n")
 
-def finalize_accuracy_report(results):
-    total = sum(1 for q, ok, _ in results if q in EXPECTED)
-    correct = sum(1 for q, ok, _ in results if q in EXPECTED and ok)
+def write_output(records):
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as fh:
+        fh.write(f"Batch NL→SQL Test Run\nTimestamp: {datetime.now()}\n")
+        fh.write("=" * 80 + "\n")
+        for i, r in enumerate(records, start=1):
+            fh.write("\n" + "#" * 80 + "\n")
+            fh.write(f"CASE {i}\n")
+            fh.write("#" * 80 + "\n")
+            write_block(fh, "Natural Language Query", r["question"])
+            write_block(fh, "Generated SQL", r["sql"] or "⚠️ None")
+            write_block(fh, "Result", r["ascii_result"] or r["error"])
+            status = "✅ PASS" if r["ok"] else "❌ FAIL"
+            write_block(fh, "Evaluation", status + ("\n" + "\n".join(r["reasons"]) if r["reasons"] else ""))
+            write_block(fh, "Latency", f"{r['latency_ms']} ms (LLM {r['llm_ms']} ms)")
+
+def finalize_accuracy_report(records):
+    scored = [r for r in records if r["question"] in EXPECTED]
+    total = len(scored)
+    correct = sum(1 for r in scored if r["ok"])
     pct = (correct / total * 100) if total else 0.0
+    latencies = [r["latency_ms"] for r in records]
 
     with open(ACCURACY_REPORT, "w", encoding="utf-8") as fh:
         fh.write("NL→SQL Accuracy Report\n")
@@ -66,69 +146,62 @@ def finalize_accuracy_report(results):
         fh.write(f"Scored cases: {total}\n")
         fh.write(f"Correct:      {correct}\n")
         fh.write(f"Accuracy:     {pct:.1f}%\n")
+        if latencies:
+            fh.write(f"Latency:      p50 {np.percentile(latencies, 50):.0f} ms, "
+                     f"p95 {np.percentile(latencies, 95):.0f} ms, max {max(latencies):.0f} ms\n")
         fh.write("-" * 80 + "\n\n")
-        for q, ok, reasons in results:
-            if q not in EXPECTED:
-                continue
-            status = "✅ PASS" if ok else "❌ FAIL"
-            fh.write(f"{status}  {q}\n")
-            for r in reasons:
-                fh.write(f"   - {r}\n")
+        for r in scored:
+            status = "✅ PASS" if r["ok"] else "❌ FAIL"
+            fh.write(f"{status}  {r['question']}  ({r['latency_ms']:.0f} ms)\n")
+            for reason in r["reasons"]:
+                fh.write(f"   - {reason}\n")
             fh.write("\n")
 
 def main():
+    parser = argparse.ArgumentParser(description="Batch NL→SQL evaluation")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BATCH_WORKERS", "4")))
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--fresh", action="store_true", help="ignore the checkpoint and rerun every case")
+    args = parser.parse_args()
+
     load_dotenv()
     api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
+    if not api_key and get_client().backend.online:   # stub/replay backends run offline
         raise ValueError("❌ GOOGLE_API_KEY not found. Set it in .env or env vars.")
 
     configure_gemini(api_key)
 
-    DB_NAME = "demo1.db"
-    conn = get_connection(DB_NAME)
-    cursor = conn.cursor()
-
-    schema_info = extract_schema(DB_NAME)
-    retriever = SchemaRetriever(schema_info)
-
-    eval_results = []
-
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as fh:
-        fh.write(f"Batch NL→SQL Test Run\nTimestamp: {datetime.now()}\n")
-        fh.write("=" * 80 + "\n")
-
-        for i, q in enumerate(QUERIES, start=1):
-            fh.write("\n" + "#" * 80 + "\n")
-            fh.write(f"CASE {i}\n")
-            fh.write("#" * 80 + "\n")
-
-            write_block(fh, "Natural Language Query", q)
-
-            try:
-                sql = nl_to_sql(q, retriever)
-            except Exception as e:
-                write_block(fh, "Generated SQL (error)", f"❌ Error generating SQL: {e}")
-                eval_results.append((q, False, [f"Generation error: {e}"]))
-                continue
-
-            write_block(fh, "Generated SQL", sql or "⚠️ None")
-
-            try:
-                result = run_sql(cursor, sql)
-            except Exception as e:
-                result = f"❌ Error running SQL: {e}"
-
-            write_block(fh, "Result", result)
-
-            ok, reasons = check_case(q, result)
-            eval_results.append((q, ok, reasons))
-            status = "✅ PASS" if ok else "❌ FAIL"
-            write_block(fh, "Evaluation", status + ("\n" + "\n".join(reasons) if reasons else ""))
-
-            fh.flush()
-
-    finalize_accuracy_report(eval_results)
-    print(f"✅ Done.\n- Detailed log: {OUTPUT_FILE}\n- Accuracy:     {ACCURACY_REPORT}")
+    pool = ConnectionPool(DB_NAME, size=args.workers)
+    schema = SchemaCatalog(DB_NAME)
+    schema_info = schema.schema_info
+    retriever = SchemaRetriever(schema_info, tables=schema.tables)
+    stats = StatsCatalog(DB_NAME)
+
+    if args.fresh and Path(args.checkpoint).exists():
+        os.remove(args.checkpoint)
+    done = load_checkpoint(args.checkpoint)
+    todo = [q for q in QUERIES if q not in done]
+    print(f"▶️ {len(todo)} case(s) to run, {len(QUERIES) - len(todo)} already in {args.checkpoint}")
+
+    if Path(args.checkpoint).exists() and not Path(args.checkpoint).read_bytes().endswith(b"\n"):
+        with open(args.checkpoint, "a", encoding="utf-8") as ckpt:
+            ckpt.write("\n")   # don't glue new records onto a torn line
+
+    start = time.perf_counter()
+    with open(args.checkpoint, "a", encoding="utf-8") as ckpt, ThreadPoolExecutor(max_workers=args.workers) as workers:
+        futures = [workers.submit(run_case, q, retriever, stats, pool) for q in todo]
+        for n, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            ckpt.write(json.dumps(record, default=str) + "\n")
+            ckpt.flush()
+            done[record["question"]] = record
+            print(f"[{n}/{len(todo)}] {'✅' if record['ok'] else '❌'} {record['latency_ms']:.0f} ms  {record['question']}")
+    pool.close()
+
+    records = [done[q] for q in QUERIES if q in done]
+    write_output(records)
+    finalize_accuracy_report(records)
+    print(f"✅ Done in {time.perf_counter() - start:.1f}s.\n- Detailed log: {OUTPUT_FILE}\n- Accuracy:     {ACCURACY_REPORT}")
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,8 @@
 import sqlite3
 from pathlib import Path
 
+from db import install_change_tracking
+
 DB = Path("demo1.db")
 
 schema = """
@@ -32,6 +34,47 @@ seed_orders = [
     (1, "Mouse",    25, "2024-02-25"),
 ]
 
+CITIES = ["New York", "San Francisco", "Chicago", "Boston", "Seattle", "Austin", "Denver", "Miami"]
+PRODUCTS = ["Laptop", "Phone", "Mouse", "Monitor", "Keyboard", "Tablet", "Headphones", "Camera"]
+
+def make_scaled_db(path, n_orders, n_customers=None, seed=0, chunk=100_000):
+    """
+    Synthetic customers/orders database with the demo schema, for
+    benchmarks: `n_orders` orders over `n_customers` (default n_orders / 10)
+    customers, random cities/products/amounts/dates, inserted in chunks so
+    10M rows fit in memory. Change tracking is installed afterwards.
+    """
+    import random
+    from datetime import date, timedelta
+
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    n_customers = n_customers or max(1, n_orders // 10)
+    rng = random.Random(seed)
+    start = date(2023, 1, 1)
+
+    conn = sqlite3.connect(path.as_posix())
+    conn.execute("PRAGMA journal_mode=OFF;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.executescript(schema)
+
+    def rows(n, make):
+        for first in range(0, n, chunk):
+            yield [make() for _ in range(min(chunk, n - first))]
+
+    for batch in rows(n_customers, lambda: (f"Customer {rng.randrange(10**9)}", rng.choice(CITIES),
+                                            (start + timedelta(days=rng.randrange(730))).isoformat())):
+        conn.executemany("INSERT INTO customers (name, city, signup_date) VALUES (?, ?, ?)", batch)
+    for batch in rows(n_orders, lambda: (rng.randrange(1, n_customers + 1), rng.choice(PRODUCTS),
+                                         round(rng.uniform(5, 2000), 2),
+                                         (start + timedelta(days=rng.randrange(730))).isoformat())):
+        conn.executemany("INSERT INTO orders (customer_id, product, amount, order_date) VALUES (?, ?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+    install_change_tracking(path.as_posix())
+    return path
+
 def main():
     first_time = not DB.exists()
     conn = sqlite3.connect(DB.as_posix())
@@ -45,6 +88,15 @@ def main():
         print("ℹ️ demo1.db already exists; left as-is.")
     conn.commit()
     conn.close()
+    install_change_tracking(DB.as_posix())
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="Create demo1.db, or a synthetic database with --rows")
+    parser.add_argument("--rows", type=int, help="number of orders for a synthetic benchmark database")
+    parser.add_argument("--db", default="bench.db", help="path of the synthetic database")
+    args = parser.parse_args()
+    if args.rows:
+        print(f"✅ Created {make_scaled_db(args.db, args.rows)} with {args.rows} orders")
+    else:
+        main()
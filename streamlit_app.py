@@ -1,8 +1,11 @@
+import json
+
 import streamlit as st
 import requests
 import pandas as pd
 
 API_URL = "http://127.0.0.1:8000/ask"   # Make sure FastAPI is running
+STREAM_URL = API_URL + "/stream"
 
 st.set_page_config(page_title="NL2SQL Demo", layout="wide")
 st.title("💬 Natural Language to SQL")
@@ -10,38 +13,58 @@ st.title("💬 Natural Language to SQL")
 # ----------------------------
 # Query Input
 # ----------------------------
+# The API keeps conversation history per session; reuse the id it hands out
+if "session_id" not in st.session_state:
+    st.session_state.session_id = None
+
 question = st.text_input("Enter your question about the database:")
 
 if st.button("Ask") and question.strip():
     with st.spinner("Thinking..."):
         try:
-            response = requests.post(API_URL, json={"question": question})
+            # Stream: SQL arrives first, then rows, then the explanation
+            response = requests.post(STREAM_URL, json={"question": question, "session_id": st.session_state.session_id},
+                                     stream=True)
             if response.status_code != 200:
                 st.error(f"API error: {response.status_code}")
             else:
-                data = response.json()
-
-                # Show SQL
                 st.subheader("Generated SQL")
-                st.code(data.get("sql", ""), language="sql")
-
-                # Show results
+                sql_box = st.empty()
                 st.subheader("Results")
-                json_result = data.get("json_result", [])
+                table_box = st.empty()
+                chart_box = st.container()
+                st.subheader("Explanation")
+                explanation_box = st.empty()
+
+                json_result = []
+                error = None
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "session":
+                        st.session_state.session_id = event["session_id"]
+                    elif event["type"] == "sql":
+                        sql_box.code(event["sql"], language="sql")
+                    elif event["type"] == "rows":
+                        json_result.extend(event["rows"])
+                        table_box.dataframe(pd.DataFrame(json_result))
+                    elif event["type"] == "explanation":
+                        explanation_box.write(event["explanation"])
+                    elif event["type"] == "error":
+                        error = event["error"]
+                        table_box.write(error)
+
                 if json_result:
                     df = pd.DataFrame(json_result)
-                    st.dataframe(df)
 
                     # Optional: if numeric column exists, show chart
                     numeric_cols = df.select_dtypes(include=["number"]).columns
                     if len(numeric_cols) >= 1:
-                        st.subheader("Chart")
-                        st.bar_chart(df.set_index(df.columns[0])[numeric_cols])
-                else:
-                    st.write(data.get("ascii_result", "⚠️ No results."))
-
-                # Explanation
-                st.subheader("Explanation")
-                st.write(data.get("explanation", ""))
+                        with chart_box:
+                            st.subheader("Chart")
+                            st.bar_chart(df.set_index(df.columns[0])[numeric_cols])
+                elif not error:
+                    table_box.write("⚠️ No results.")
         except Exception as e:
             st.error(f"❌ Exception: {e}")
@@ -1,18 +1,20 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
 import os
-import re
+from typing import Optional
 from fastapi import FastAPI
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-from cache_manager import QueryCache
-from context_manager import ContextManager
-from db import get_connection, extract_schema
+from cache_manager import QueryCache, ResultCache
+from context_manager import SessionStore
+from db import get_connection, SchemaCatalog, ChangeTracker
 from retriever import SchemaRetriever
+from profiler import StatsCatalog
+from llm_client import get_client
 from query_engine import configure_gemini, nl_to_sql, run_sql
-from validator import repair_sql
+from validator import prepare_sql, repair_sql
 from explainer import explain_result
 from logger import log_query
 
@@ -21,7 +23,7 @@ from logger import log_query
 # ----------------------------
 load_dotenv()
 api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
+if not api_key and get_client().backend.online:   # stub/replay backends run offline
     raise ValueError("❌ GOOGLE_API_KEY not found. Please set it in .env")
 
 configure_gemini(api_key)
@@ -29,24 +31,15 @@ configure_gemini(api_key)
 DB_NAME = "demo1.db"
 conn = get_connection(DB_NAME)
 cursor = conn.cursor()
-schema_info = extract_schema(DB_NAME)
-retriever = SchemaRetriever(schema_info)
-
-context = ContextManager()
-cache = QueryCache()
-
-# ----------------------------
-# Helpers
-# ----------------------------
-def normalize_for_cache(enriched_question):
-    if "Follow-up question:" in enriched_question:
-        return enriched_question.split("Follow-up question:")[-1].strip()
-    return enriched_question.strip()
+schema = SchemaCatalog(DB_NAME)
+schema_info = schema.schema_info
+retriever = SchemaRetriever(schema_info, tables=schema.tables)
+stats = StatsCatalog(DB_NAME)
 
-def normalize(text):
-    text = text.lower().strip()
-    text = re.sub(r"[^a-z0-9\s]", "", text)  # remove punctuation
-    return text
+sessions = SessionStore.from_env()
+tracker = ChangeTracker(DB_NAME)
+cache = QueryCache.from_env(tracker=tracker)
+results = ResultCache.from_env(tracker)
 
 # ----------------------------
 # FastAPI App
@@ -55,53 +48,83 @@ app = FastAPI(title="NL2SQL API", version="1.0")
 
 class QueryRequest(BaseModel):
     question: str
+    session_id: Optional[str] = None   # omit to start a new session; the id is returned
+    explain: bool = True   # False: skip the explanation; fetch it later via /explain/{result_id}
+
+def explanation_for(question, sql, ascii_result, want=True):
+    """(result_id, explanation) — memoised; None when not wanted and not cached."""
+    result_id, explanation = cache.explanations.lookup(question, sql, ascii_result)
+    if explanation is None and want:
+        explanation = explain_result(question, sql, ascii_result)
+        cache.explanations.put(result_id, explanation)
+    return result_id, explanation
 
 @app.post("/ask")
 def ask(request: QueryRequest):
     question = request.question
 
     # --- Enrich with context ---
+    session_id, context = sessions.get(request.session_id)
     enriched_question = context.build_context_prompt(question)
-    cache_key = normalize(normalize_for_cache(enriched_question))
+    cache_key = enriched_question   # follow-ups are only reused with the same history
 
     # --- Check cache ---
-    cached = cache.search(cache_key)
+    cached = cache.search(cache_key, semantic=not context.history)
     if cached:
         sql, (json_result, ascii_result) = cached
-        explanation = explain_result(question, sql, ascii_result)
-        context.add_entry(question, sql, ascii_result)
-        log_query(question, sql, ascii_result + "\nExplanation: " + explanation)
+        result_id, explanation = explanation_for(question, sql, ascii_result, request.explain)
+        sessions.add_entry(session_id, question, sql, (json_result, ascii_result))
+        log_query(question, sql, (json_result, ascii_result), cached=True, session_id=session_id,
+                  explanation=explanation)
         return {
             "sql": sql,
             "json_result": json_result,   # 👈 structured JSON for Streamlit
             "ascii_result": ascii_result, # 👈 for logs/debug
             "explanation": explanation,
-            "cached": True
+            "result_id": result_id,
+            "cached": True,
+            "session_id": session_id
         }
 
     # --- Generate SQL ---
-    sql = nl_to_sql(enriched_question, retriever)
-    json_result, ascii_result = run_sql(cursor, sql)
+    sql = nl_to_sql(enriched_question, retriever, stats=stats)
+    sql, _ = prepare_sql(cursor, sql, schema_info)   # local fixes before any LLM repair
+    json_result, ascii_result = run_sql(cursor, sql, results=results)
 
 
     # --- Repair if needed ---
     if isinstance(ascii_result, str) and ascii_result.startswith("❌ Error"):
         fixed_sql = repair_sql(question, sql, ascii_result, schema_info)
-        json_result, ascii_result = run_sql(cursor, fixed_sql)
+        fixed_sql, _ = prepare_sql(cursor, fixed_sql, schema_info)
+        json_result, ascii_result = run_sql(cursor, fixed_sql, results=results)
         sql = fixed_sql   
 
     # --- Explanation ---
-    explanation = explain_result(question, sql, ascii_result)
+    result_id, explanation = explanation_for(question, sql, ascii_result, request.explain)
 
     # --- Save ---
-    context.add_entry(question, sql, ascii_result)
+    sessions.add_entry(session_id, question, sql, (json_result, ascii_result))
     cache.add(cache_key, sql, (json_result, ascii_result))
-    log_query(question, sql, ascii_result + "\nExplanation: " + explanation)
+    log_query(question, sql, (json_result, ascii_result), cached=False, session_id=session_id,
+              explanation=explanation)
 
     return {
         "sql": sql,
         "json_result": json_result,
         "ascii_result": ascii_result,
         "explanation": explanation,
-        "cached": False
+        "result_id": result_id,
+        "cached": False,
+        "session_id": session_id
     }
+
+@app.get("/explain/{result_id}")
+def explain(result_id: str):
+    """Explanation for an earlier /ask result (computed now if it was skipped)."""
+    explanation = cache.explanations.get(result_id)
+    if explanation is None:
+        inputs = cache.explanations.inputs(result_id)
+        if inputs is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired result_id")
+        _, explanation = explanation_for(*inputs)
+    return {"result_id": result_id, "explanation": explanation}
@@ -1,5 +1,4 @@
 import requests
-import time
 
 API_URL = "http://127.0.0.1:8000/ask"
 
@@ -32,12 +31,12 @@ with open("test_results.txt", "w", encoding="utf-8") as f:
             response = requests.post(API_URL, json=payload)
             data = response.json()
         except Exception as e:
-            data = {"sql": "", "result": f"❌ Request failed: {e}", "explanation": "", "cache": False}
+            data = {"sql": "", "ascii_result": f"❌ Request failed: {e}", "explanation": "", "cached": False}
 
         sql = data.get("sql", "❌ No SQL returned")
-        result = data.get("result", "❌ No result")
+        result = data.get("ascii_result", "❌ No result")
         explanation = data.get("explanation", "❌ No explanation")
-        cache_hit = str(data.get("cache", False))
+        cache_hit = str(data.get("cached", False))
 
         # Log results
         f.write("\n" + "#"*80 + f"\nCASE {i}\n" + "#"*80 + "\n")
@@ -66,11 +65,6 @@ with open("test_results.txt", "w", encoding="utf-8") as f:
 
         f.write("\n\n")
 
-        # Pause after every 3 queries to respect Gemini rate limit
-        if i % 3 == 0:
-            print(f"⏳ Sleeping 10s after {i} queries...")
-            time.sleep(10)
-
 # Final stats
 with open("test_results.txt", "a", encoding="utf-8") as f:
     f.write("\n" + "="*80 + "\n")
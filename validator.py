@@ -1,10 +1,187 @@
-import google.generativeai as genai
+import difflib
+import re
+import threading
+from collections import Counter
 
-def repair_sql(question, sql, error_message, schema_info, model_name="gemini-2.0-flash"):
+import metrics
+from llm_client import get_client
+
+# How often each repair path was taken (local fixes save an LLM round trip)
+REPAIR_STATS = Counter()
+_stats_lock = threading.Lock()
+
+metrics.register_collector(lambda: [("nl2sql_sql_repairs_total", {"path": k}, v) for k, v in REPAIR_STATS.items()])
+
+def _count(key):
+    with _stats_lock:
+        REPAIR_STATS[key] += 1
+
+# ----------------------------
+# Local validation + deterministic repair
+# ----------------------------
+def parse_schema(schema_info):
+    """{table: [columns]} from extract_schema() lines ("Table t: a (TYPE), b (TYPE)")."""
+    schema = {}
+    for line in schema_info:
+        match = re.match(r"Table (\S+): ?(.*)", line)
+        if match:
+            columns = [c.strip().split(" (")[0] for c in match.group(2).split(",") if c.strip()]
+            schema[match.group(1)] = columns
+    return schema
+
+def precheck_sql(cursor, sql):
     """
-    Ask Gemini to fix SQL query based on error message and schema.
+    Compile `sql` with EXPLAIN (prepares the statement, does not run the
+    query). Returns the SQLite error message, or None if it is valid.
+    """
+    try:
+        cursor.execute("EXPLAIN " + sql.strip().rstrip(";"))
+        cursor.fetchall()
+        return None
+    except Exception as e:
+        return str(e)
+
+def _outside_strings(sql, fn):
+    """Apply fn to the parts of sql that are not single-quoted literals."""
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    return "".join(part if i % 2 else fn(part) for i, part in enumerate(parts))
+
+def _replace_identifier(sql, old, new):
+    pattern = re.compile(rf"(?<![\w]){re.escape(old)}(?![\w])")
+    return _outside_strings(sql, lambda part: pattern.sub(new, part))
+
+def _edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def _singular(word):
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def _is_near_typo(name, candidate):
+    """Plural/singular of each other, or a typo: ratio >= 0.85 or edit distance <= 2 (and <= len/4)."""
+    if _singular(name) == _singular(candidate):
+        return True
+    if difflib.SequenceMatcher(None, name, candidate).ratio() >= 0.85:
+        return True
+    distance = _edit_distance(name, candidate)
+    return distance <= 2 and distance <= len(name) // 4
+
+def _closest(name, candidates):
+    """
+    The schema name `name` was most likely meant as, only when it is a
+    near-typo of exactly one candidate; anything else (e.g. a hallucinated
+    `country` column) is left to the LLM repair step.
+    """
+    by_lower = {c.lower(): c for c in candidates}
+    matches = [c for c in by_lower if _is_near_typo(name.lower(), c)]
+    if len(matches) != 1:
+        return None
+    return by_lower[matches[0]]
+
+CURLY_QUOTES = str.maketrans({"\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"'})
+
+def _normalize_quotes(sql):
+    """
+    Curly quotes → straight quotes outside string literals (an apostrophe
+    inside 'O’Brien' is data); backticks are left to SQLite.
+    """
+    return _outside_strings(sql, lambda part: part.translate(CURLY_QUOTES))
+
+def local_fix(sql, error, schema):
+    """
+    One deterministic fix for a common failure, or None:
+    - curly quotes around a literal or identifier → straight quotes
+    - no such table / column → closest name from the schema
+    - "double quoted" string literal read as a column → 'single quoted'
+    - unterminated 'literal / unclosed ( → close the statement
+    """
+    normalized = _normalize_quotes(sql)
+    if normalized != sql:
+        return normalized
+
+    match = re.search(r"no such table: (?:\w+\.)?(\w+)", error)
+    if match:
+        table = _closest(match.group(1), schema)
+        return _replace_identifier(sql, match.group(1), table) if table else None
+
+    match = re.search(r"no such column: (?:[\w]+\.)?(.+)$", error)
+    if match:
+        name = match.group(1).strip()
+        if f'"{name}"' in sql:
+            return sql.replace(f'"{name}"', "'" + name.replace("'", "''") + "'")
+        referenced = [t for t in schema if re.search(rf"\b{re.escape(t)}\b", sql, re.I)]
+        for tables in (referenced, list(schema)):
+            column = _closest(name, [c for t in tables for c in schema[t]])
+            if column:
+                return _replace_identifier(sql, name, column)
+        return None
+
+    # An unterminated literal swallows the rest of the statement, so SQLite
+    # reports the literal itself (unrecognized token: "'Laptop"), not "incomplete input"
+    if error.startswith("unrecognized token: \"'") and sql.count("'") % 2:
+        return sql.rstrip().rstrip(";") + "';"
+    if "incomplete input" in error and sql.count("(") > sql.count(")"):
+        return sql.rstrip().rstrip(";") + ")" * (sql.count("(") - sql.count(")")) + ";"
+    return None
+
+def prepare_sql(cursor, sql, schema_info, max_fixes=3):
+    """
+    Validate SQL locally before execution and apply deterministic fixes.
+    Returns (sql, error): error is None when the (possibly fixed) SQL
+    compiles; otherwise it is the SQLite error for the LLM repair step.
     """
-    prompt = f"""
+    if sql is None:
+        return sql, None
+    sql = sql.strip()
+    if not sql.endswith(";"):
+        sql += ";"
+
+    _count("prechecked")
+    error = precheck_sql(cursor, sql)
+    if error is None:
+        return sql, None
+
+    schema = parse_schema(schema_info)
+    candidate = sql
+    for _ in range(max_fixes):
+        candidate = local_fix(candidate, error, schema)
+        if candidate is None:
+            break
+        error = precheck_sql(cursor, candidate)
+        if error is None:
+            _count("local_fixes")
+            print(f"[SQL FIX] {sql} → {candidate}")
+            return candidate, None
+
+    _count("needs_llm")
+    return sql, precheck_sql(cursor, sql)
+
+def narrow_schema(schema_info, sql, error_message=""):
+    """Schema lines for the tables the SQL uses (all of them if it names none, or a table is missing)."""
+    if "no such table" in (error_message or ""):
+        return schema_info
+    schema = parse_schema(schema_info)
+    used = {t for t in schema if re.search(rf"\b{re.escape(t)}\b", sql or "", re.I)}
+    narrowed = [line for line, t in zip(schema_info, schema) if t in used] if len(schema) == len(schema_info) else []
+    return narrowed or schema_info
+
+# ----------------------------
+# LLM repair (fallback)
+# ----------------------------
+def build_repair_prompt(question, sql, error_message, schema_info):
+    """Prompt asking Gemini to fix `sql` given the error it raised."""
+    return f"""
     You are an assistant that fixes invalid SQL queries.
     
     Schema:
@@ -26,10 +203,23 @@ def repair_sql(question, sql, error_message, schema_info, model_name="gemini-2.0
     - Only return a valid SQL query
     """
 
-    model = genai.GenerativeModel(model_name)
-    response = model.generate_content(prompt)
-    fixed_sql = response.text.strip()
-
+def _strip_fences(text):
+    fixed_sql = text.strip()
     if "```" in fixed_sql:
         fixed_sql = fixed_sql.replace("```sql", "").replace("```", "")
     return fixed_sql.strip()
+
+def repair_sql(question, sql, error_message, schema_info, model_name="gemini-2.0-flash"):
+    """
+    Ask Gemini to fix SQL query based on error message and schema.
+    Only the schema of the tables the query uses is sent.
+    """
+    _count("llm_repairs")
+    prompt = build_repair_prompt(question, sql, error_message, narrow_schema(schema_info, sql, error_message))
+    return _strip_fences(get_client().generate(prompt, model_name))
+
+async def repair_sql_async(question, sql, error_message, schema_info, model_name="gemini-2.0-flash"):
+    """Async repair_sql using Gemini's async client."""
+    _count("llm_repairs")
+    prompt = build_repair_prompt(question, sql, error_message, narrow_schema(schema_info, sql, error_message))
+    return _strip_fences(await get_client().generate_async(prompt, model_name))